@@ -4,8 +4,9 @@ import asyncio
 import signal
 
 from shop_bot.webhook_server.app import create_webhook_app
-from shop_bot.data_manager.scheduler import periodic_subscription_check
+from shop_bot.data_manager.scheduler import periodic_subscription_check, periodic_wal_checkpoint, periodic_stats_rebuild, run_expiry_notifier
 from shop_bot.data_manager import database
+from shop_bot.modules import xui_api
 from shop_bot.bot_controller import BotController
 
 def main():
@@ -30,6 +31,7 @@ def main():
         if tasks:
             [task.cancel() for task in tasks]
             await asyncio.gather(*tasks, return_exceptions=True)
+        await xui_api.close_sessions()
         loop.stop()
 
     async def start_services():
@@ -51,12 +53,16 @@ def main():
         logger.info("Application is running. Bot can be started from the web panel.")
         
         asyncio.create_task(periodic_subscription_check(bot_controller))
+        asyncio.create_task(run_expiry_notifier(bot_controller))
+        asyncio.create_task(periodic_wal_checkpoint())
+        asyncio.create_task(periodic_stats_rebuild())
 
         await asyncio.Future()
 
     try:
         asyncio.run(start_services())
     finally:
+        database.close_connections()
         logger.info("Application is shutting down.")
 
 if __name__ == "__main__":
@@ -33,16 +33,7 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.bot import keyboards
 from shop_bot.modules import xui_api
-from shop_bot.data_manager.database import (
-    get_user, add_new_key, get_user_keys, update_user_stats,
-    register_user_if_not_exists, get_next_key_number, get_key_by_id,
-    update_key_info, set_trial_used, set_terms_agreed, get_setting, get_all_hosts,
-    get_plans_for_host, get_plan_by_id, log_transaction, get_referral_count,
-    add_to_referral_balance, create_pending_transaction, get_all_users,
-    set_referral_balance, set_referral_balance_all, create_bank_payment_document,
-    get_transaction_by_id, update_bank_payment_document_status, get_bank_payment_document,
-    update_transaction_status
-)
+from shop_bot.data_manager.database import aio, get_setting
 
 from shop_bot.config import (
     get_profile_text, get_vpn_active_text, VPN_INACTIVE_TEXT, VPN_NO_DATA_TEXT,
@@ -106,8 +97,8 @@ def get_welcome_photo_path(photo_path_setting: str):
 
 async def show_main_menu(message: types.Message, edit_message: bool = False):
     user_id = message.chat.id
-    user_db_data = get_user(user_id)
-    user_keys = get_user_keys(user_id)
+    user_db_data = await aio.get_user(user_id)
+    user_keys = await aio.get_user_keys(user_id)
     
     trial_available = not (user_db_data and user_db_data.get('trial_used'))
     is_admin = str(user_id) == ADMIN_ID
@@ -127,7 +118,7 @@ def registration_required(f):
     @wraps(f)
     async def decorated_function(event: types.Update, *args, **kwargs):
         user_id = event.from_user.id
-        user_data = get_user(user_id)
+        user_data = await aio.get_user(user_id)
         if user_data:
             return await f(event, *args, **kwargs)
         else:
@@ -156,10 +147,10 @@ def get_user_router() -> Router:
             except (IndexError, ValueError):
                 logger.warning(f"Invalid referral code received: {command.args}")
                 
-        register_user_if_not_exists(user_id, username, referrer_id)
+        await aio.register_user_if_not_exists(user_id, username, referrer_id)
         user_id = message.from_user.id
         username = message.from_user.username or message.from_user.full_name
-        user_data = get_user(user_id)
+        user_data = await aio.get_user(user_id)
 
         if user_data and user_data.get('agreed_to_terms'):
             # Показываем приветственное сообщение с фото (если настроено)
@@ -212,7 +203,7 @@ def get_user_router() -> Router:
         channel_url = get_setting("channel_url")
 
         if not channel_url or not terms_url or not privacy_url:
-            set_terms_agreed(user_id)
+            await aio.set_terms_agreed(user_id)
             # Показываем приветственное сообщение с фото (если настроено)
             welcome_text = get_setting("welcome_message_text")
             welcome_photo_path = get_setting("welcome_message_photo_path")
@@ -263,7 +254,7 @@ def get_user_router() -> Router:
         show_welcome_screen = (is_subscription_forced and channel_url) or (terms_url and privacy_url)
 
         if not show_welcome_screen:
-            set_terms_agreed(user_id)
+            await aio.set_terms_agreed(user_id)
             # Показываем приветственное сообщение с фото (если настроено)
             welcome_text = get_setting("welcome_message_text")
             welcome_photo_path = get_setting("welcome_message_photo_path")
@@ -384,19 +375,17 @@ def get_user_router() -> Router:
     async def profile_handler_callback(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
-        user_keys = get_user_keys(user_id)
+        user_db_data = await aio.get_user(user_id)
+        user_keys = await aio.get_user_keys(user_id)
         if not user_db_data:
             await callback.answer("Не удалось получить данные профиля.", show_alert=True)
             return
         username = html.bold(user_db_data.get('username', 'Пользователь'))
         total_spent, total_months = user_db_data.get('total_spent', 0), user_db_data.get('total_months', 0)
-        now = datetime.now()
-        active_keys = [key for key in user_keys if datetime.fromisoformat(key['expiry_date']) > now]
-        if active_keys:
-            latest_key = max(active_keys, key=lambda k: datetime.fromisoformat(k['expiry_date']))
-            latest_expiry_date = datetime.fromisoformat(latest_key['expiry_date'])
-            time_left = latest_expiry_date - now
+        now_ms = int(datetime.now().timestamp() * 1000)
+        latest_expiry_ms = max((key['expiry_ms'] for key in user_keys), default=0)
+        if latest_expiry_ms > now_ms:
+            time_left = timedelta(milliseconds=latest_expiry_ms - now_ms)
             vpn_status_text = get_vpn_active_text(time_left.days, time_left.seconds // 3600)
         elif user_keys: vpn_status_text = VPN_INACTIVE_TEXT
         else: vpn_status_text = VPN_NO_DATA_TEXT
@@ -520,7 +509,7 @@ def get_user_router() -> Router:
 
         await state.clear()
         
-        users = get_all_users()
+        users = await aio.get_all_users()
         logger.info(f"Broadcast: Starting to iterate over {len(users)} users.")
 
         sent_count = 0
@@ -566,11 +555,11 @@ def get_user_router() -> Router:
     async def referral_program_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_data = get_user(user_id)
+        user_data = await aio.get_user(user_id)
         bot_username = (await callback.bot.get_me()).username
         
         referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
-        referral_count = get_referral_count(user_id)
+        referral_count = await aio.get_referral_count(user_id)
         balance = user_data.get('referral_balance', 0)
 
         text = (
@@ -602,7 +591,7 @@ def get_user_router() -> Router:
     @registration_required
     async def process_withdraw_details(message: types.Message, state: FSMContext):
         user_id = message.from_user.id
-        user = get_user(user_id)
+        user = await aio.get_user(user_id)
         balance = user.get('referral_balance', 0)
         details = message.text.strip()
         if balance < 100:
@@ -629,13 +618,13 @@ def get_user_router() -> Router:
             return
         try:
             user_id = int(message.text.split("_")[-1])
-            user = get_user(user_id)
+            user = await aio.get_user(user_id)
             balance = user.get('referral_balance', 0)
             if balance < 100:
                 await message.answer("Баланс пользователя менее 100 руб.")
                 return
-            set_referral_balance(user_id, 0)
-            set_referral_balance_all(user_id, 0)
+            await aio.set_referral_balance(user_id, 0)
+            await aio.set_referral_balance_all(user_id, 0)
             await message.answer(f"✅ Выплата {balance:.2f} RUB пользователю {user_id} подтверждена.")
             await message.bot.send_message(
                 user_id,
@@ -719,7 +708,7 @@ def get_user_router() -> Router:
     async def manage_keys_handler(callback: types.CallbackQuery):
         await callback.answer()
         user_id = callback.from_user.id
-        user_keys = get_user_keys(user_id)
+        user_keys = await aio.get_user_keys(user_id)
         await callback.message.edit_text(
             "Ваши ключи:" if user_keys else "У вас пока нет ключей.",
             reply_markup=keyboards.create_keys_management_keyboard(user_keys)
@@ -729,12 +718,12 @@ def get_user_router() -> Router:
     @registration_required
     async def trial_period_handler(callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        user_db_data = get_user(user_id)
+        user_db_data = await aio.get_user(user_id)
         if user_db_data and user_db_data.get('trial_used'):
             await callback.answer("Вы уже использовали бесплатный пробный период.", show_alert=True)
             return
 
-        hosts = get_all_hosts()
+        hosts = await aio.get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для создания пробного ключа.")
             return
@@ -749,6 +738,10 @@ def get_user_router() -> Router:
                 reply_markup=keyboards.create_host_selection_keyboard(hosts, action="trial")
             )
 
+    @user_router.callback_query(F.data == "host_unavailable")
+    async def host_unavailable_handler(callback: types.CallbackQuery):
+        await callback.answer("Этот сервер временно недоступен. Попробуйте позже или выберите другой.", show_alert=True)
+
     @user_router.callback_query(F.data.startswith("select_host_trial_"))
     @registration_required
     async def trial_host_selection_handler(callback: types.CallbackQuery):
@@ -763,16 +756,16 @@ def get_user_router() -> Router:
         try:
             result = await xui_api.create_or_update_key_on_host(
                 host_name=host_name,
-                email=f"user{user_id}-key{get_next_key_number(user_id)}-trial@telegram.bot",
+                email=f"user{user_id}-key{await aio.get_next_key_number(user_id)}-trial@telegram.bot",
                 days_to_add=int(get_setting("trial_duration_days"))
             )
             if not result:
                 await message.edit_text("❌ Не удалось создать пробный ключ. Ошибка на сервере.")
                 return
 
-            set_trial_used(user_id)
+            await aio.set_trial_used(user_id)
             
-            new_key_id = add_new_key(
+            new_key_id = await aio.add_new_key(
                 user_id=user_id,
                 host_name=host_name,
                 xui_client_uuid=result['client_uuid'],
@@ -782,7 +775,7 @@ def get_user_router() -> Router:
             
             await message.delete()
             new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
-            final_text = get_purchase_success_text("готов", get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
+            final_text = get_purchase_success_text("готов", await aio.get_next_key_number(user_id) -1, new_expiry_date, result['connection_string'])
             await message.answer(text=final_text, reply_markup=keyboards.create_key_info_keyboard(new_key_id))
 
         except Exception as e:
@@ -795,7 +788,7 @@ def get_user_router() -> Router:
         key_id_to_show = int(callback.data.split("_")[2])
         await callback.message.edit_text("Загружаю информацию о ключе...")
         user_id = callback.from_user.id
-        key_data = get_key_by_id(key_id_to_show)
+        key_data = await aio.get_key_by_id(key_id_to_show)
 
         if not key_data or key_data['user_id'] != user_id:
             await callback.message.edit_text("❌ Ошибка: ключ не найден.")
@@ -808,10 +801,10 @@ def get_user_router() -> Router:
                 return
 
             connection_string = details['connection_string']
-            expiry_date = datetime.fromisoformat(key_data['expiry_date'])
+            expiry_date = datetime.fromtimestamp(key_data['expiry_ms'] / 1000)
             created_date = datetime.fromisoformat(key_data['created_date'])
             
-            all_user_keys = get_user_keys(user_id)
+            all_user_keys = await aio.get_user_keys(user_id)
             key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id_to_show), 0)
             
             final_text = get_key_info_text(key_number, expiry_date, created_date, connection_string)
@@ -830,7 +823,7 @@ def get_user_router() -> Router:
     async def show_qr_handler(callback: types.CallbackQuery):
         await callback.answer("Генерирую QR-код...")
         key_id = int(callback.data.split("_")[2])
-        key_data = get_key_by_id(key_id)
+        key_data = await aio.get_key_by_id(key_id)
         if not key_data or key_data['user_id'] != callback.from_user.id: return
         
         try:
@@ -891,7 +884,7 @@ def get_user_router() -> Router:
     @registration_required
     async def buy_new_key_handler(callback: types.CallbackQuery):
         await callback.answer()
-        hosts = get_all_hosts()
+        hosts = await aio.get_all_hosts()
         if not hosts:
             await callback.message.edit_text("❌ В данный момент нет доступных серверов для покупки.")
             return
@@ -906,7 +899,7 @@ def get_user_router() -> Router:
     async def select_host_for_purchase_handler(callback: types.CallbackQuery):
         await callback.answer()
         host_name = callback.data[len("select_host_new_"):]
-        plans = get_plans_for_host(host_name)
+        plans = await aio.get_plans_for_host(host_name)
         if not plans:
             await callback.message.edit_text(f"❌ Для сервера \"{host_name}\" не настроены тарифы.")
             return
@@ -926,7 +919,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Произошла ошибка. Неверный формат ключа.")
             return
 
-        key_data = get_key_by_id(key_id)
+        key_data = await aio.get_key_by_id(key_id)
 
         if not key_data or key_data['user_id'] != callback.from_user.id:
             await callback.message.edit_text("❌ Ошибка: Ключ не найден или не принадлежит вам.")
@@ -937,7 +930,7 @@ def get_user_router() -> Router:
             await callback.message.edit_text("❌ Ошибка: У этого ключа не указан сервер. Обратитесь в поддержку.")
             return
 
-        plans = get_plans_for_host(host_name)
+        plans = await aio.get_plans_for_host(host_name)
 
         if not plans:
             await callback.message.edit_text(
@@ -1019,8 +1012,8 @@ def get_user_router() -> Router:
 
     async def show_payment_options(message: types.Message, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(message.chat.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await aio.get_user(message.chat.id)
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await message.edit_text("❌ Ошибка: Тариф не найден.")
@@ -1073,10 +1066,10 @@ def get_user_router() -> Router:
         await callback.answer("Создаю ссылку на оплату...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await aio.get_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await aio.get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1099,7 +1092,7 @@ def get_user_router() -> Router:
         action = data.get('action')
         key_id = data.get('key_id')
 
-        plan = get_plan_by_id(plan_id)
+        plan = await aio.get_plan_by_id(plan_id)
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
             await state.clear()
@@ -1153,7 +1146,7 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет в Crypto Pay...")
         
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
+        user_data = await aio.get_user(callback.from_user.id)
         
         plan_id = data.get('plan_id')
         user_id = data.get('user_id', callback.from_user.id)
@@ -1169,7 +1162,7 @@ def get_user_router() -> Router:
             await state.clear()
             return
 
-        plan = get_plan_by_id(plan_id)
+        plan = await aio.get_plan_by_id(plan_id)
         if not plan:
             logger.error(f"Attempt to create Crypto Pay invoice failed for user {user_id}: Plan with id {plan_id} not found.")
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1177,7 +1170,7 @@ def get_user_router() -> Router:
             return
         
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await aio.get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1242,8 +1235,8 @@ def get_user_router() -> Router:
         await callback.answer("Создаю счет Heleket...")
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
+        user_data = await aio.get_user(callback.from_user.id)
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1251,7 +1244,7 @@ def get_user_router() -> Router:
             return
 
         plan_id = data.get('plan_id')
-        plan = get_plan_by_id(plan_id)
+        plan = await aio.get_plan_by_id(plan_id)
 
         if not plan:
             await callback.message.answer("Произошла ошибка при выборе тарифа.")
@@ -1294,7 +1287,7 @@ def get_user_router() -> Router:
         data = await state.get_data()
         user_id = callback.from_user.id
         wallet_address = get_setting("ton_wallet_address")
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
         
         if not wallet_address or not plan:
             await callback.message.edit_text("❌ Оплата через TON временно недоступна.")
@@ -1323,7 +1316,7 @@ def get_user_router() -> Router:
             "host_name": data.get('host_name'), "plan_id": data.get('plan_id'),
             "customer_email": data.get('customer_email'), "payment_method": "TON Connect"
         }
-        create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
+        await aio.create_pending_transaction(payment_id, user_id, float(price_rub), metadata)
 
         transaction_payload = {
             'messages': [{'address': wallet_address, 'amount': str(amount_nanoton), 'payload': payment_id}],
@@ -1363,8 +1356,8 @@ def get_user_router() -> Router:
         await callback.answer()
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
-        user_data = get_user(callback.from_user.id)
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
+        user_data = await aio.get_user(callback.from_user.id)
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1406,7 +1399,7 @@ def get_user_router() -> Router:
         await callback.answer()
         
         data = await state.get_data()
-        plan = get_plan_by_id(data.get('plan_id'))
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await callback.message.edit_text("❌ Произошла ошибка при выборе тарифа.")
@@ -1427,7 +1420,7 @@ def get_user_router() -> Router:
             "payment_method": "Банковская карта РФ"
         }
         
-        transaction_id = create_pending_transaction(
+        transaction_id = await aio.create_pending_transaction(
             payment_id,
             callback.from_user.id,
             float(data.get('final_price', plan['price'])),
@@ -1473,7 +1466,7 @@ def get_user_router() -> Router:
             return
 
         # Сохраняем документ в БД
-        document_id = create_bank_payment_document(
+        document_id = await aio.create_bank_payment_document(
             transaction_id=transaction_id,
             user_id=message.from_user.id,
             file_id=file_id,
@@ -1491,9 +1484,9 @@ def get_user_router() -> Router:
             if admin_id:
                 try:
                     bot = message.bot
-                    user_info = get_user(message.from_user.id)
+                    user_info = await aio.get_user(message.from_user.id)
                     username = user_info.get('username', 'N/A') if user_info else 'N/A'
-                    plan = get_plan_by_id(data.get('plan_id'))
+                    plan = await aio.get_plan_by_id(data.get('plan_id'))
                     plan_name = plan.get('plan_name', 'N/A') if plan else 'N/A'
                     
                     if file_type == "photo":
@@ -1579,7 +1572,7 @@ def get_user_router() -> Router:
             document_id = int(parts[2])
             transaction_id = int(parts[3])
             
-            document = get_bank_payment_document(document_id)
+            document = await aio.get_bank_payment_document(document_id)
             if not document:
                 await callback.answer("❌ Документ не найден.", show_alert=True)
                 return
@@ -1588,16 +1581,16 @@ def get_user_router() -> Router:
                 await callback.answer("❌ Этот документ уже был обработан.", show_alert=True)
                 return
 
-            transaction = get_transaction_by_id(transaction_id)
+            transaction = await aio.get_transaction_by_id(transaction_id)
             if not transaction:
                 await callback.answer("❌ Транзакция не найдена.", show_alert=True)
                 return
 
             # Обновляем статус документа
-            update_bank_payment_document_status(document_id, 'approved', callback.from_user.id)
+            await aio.update_bank_payment_document_status(document_id, 'approved', callback.from_user.id)
 
             # Обновляем статус транзакции
-            update_transaction_status(transaction_id, 'paid', 'Банковская карта РФ')
+            await aio.update_transaction_status(transaction_id, 'paid', 'Банковская карта РФ')
             
             metadata = json.loads(transaction['metadata'])
             
@@ -1639,7 +1632,7 @@ def get_user_router() -> Router:
             document_id = int(parts[2])
             transaction_id = int(parts[3])
             
-            document = get_bank_payment_document(document_id)
+            document = await aio.get_bank_payment_document(document_id)
             if not document:
                 await callback.answer("❌ Документ не найден.", show_alert=True)
                 return
@@ -1649,7 +1642,7 @@ def get_user_router() -> Router:
                 return
 
             # Обновляем статус документа
-            update_bank_payment_document_status(document_id, 'rejected', callback.from_user.id)
+            await aio.update_bank_payment_document_status(document_id, 'rejected', callback.from_user.id)
 
             # Уведомляем пользователя
             try:
@@ -1678,8 +1671,8 @@ def get_user_router() -> Router:
     @user_router.callback_query(PaymentProcess.waiting_for_payment_method, F.data == "back_to_payment_method")
     async def back_to_payment_method_handler(callback: types.CallbackQuery, state: FSMContext):
         data = await state.get_data()
-        user_data = get_user(callback.from_user.id)
-        plan = get_plan_by_id(data.get('plan_id'))
+        user_data = await aio.get_user(callback.from_user.id)
+        plan = await aio.get_plan_by_id(data.get('plan_id'))
         
         if not plan:
             await callback.message.edit_text("❌ Ошибка: Тариф не найден.")
@@ -1780,7 +1773,7 @@ async def _start_ton_connect_process(user_id: int, transaction_payload: dict) ->
 
 async def process_successful_onboarding(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("✅ Спасибо! Доступ предоставлен.")
-    set_terms_agreed(callback.from_user.id)
+    await aio.set_terms_agreed(callback.from_user.id)
     await state.clear()
     await callback.message.delete()
     
@@ -1855,8 +1848,8 @@ async def notify_admin_of_purchase(bot: Bot, metadata: dict):
         plan_id = metadata.get('plan_id')
         payment_method = metadata.get('payment_method', 'Unknown')
         
-        user_info = get_user(user_id)
-        plan_info = get_plan_by_id(plan_id)
+        user_info = await aio.get_user(user_id)
+        plan_info = await aio.get_plan_by_id(plan_id)
 
         username = user_info.get('username', 'N/A') if user_info else 'N/A'
         plan_name = plan_info.get('plan_name', f'{months} мес.') if plan_info else f'{months} мес.'
@@ -2011,10 +2004,10 @@ async def process_successful_payment(bot: Bot, metadata: dict):
     try:
         email = ""
         if action == "new":
-            key_number = get_next_key_number(user_id)
+            key_number = await aio.get_next_key_number(user_id)
             email = f"user{user_id}-key{key_number}@{host_name.replace(' ', '').lower()}.bot"
         elif action == "extend":
-            key_data = get_key_by_id(key_id)
+            key_data = await aio.get_key_by_id(key_id)
             if not key_data or key_data['user_id'] != user_id:
                 await processing_message.edit_text("❌ Ошибка: ключ для продления не найден.")
                 return
@@ -2031,72 +2024,46 @@ async def process_successful_payment(bot: Bot, metadata: dict):
             await processing_message.edit_text("❌ Не удалось создать/обновить ключ в панели.")
             return
 
-        if action == "new":
-            key_id = add_new_key(user_id, host_name, result['client_uuid'], result['email'], result['expiry_timestamp_ms'])
-        elif action == "extend":
-            update_key_info(key_id, result['client_uuid'], result['expiry_timestamp_ms'])
-        
-        price = float(metadata.get('price')) 
-
-        user_data = get_user(user_id)
-        referrer_id = user_data.get('referred_by')
-
-        if referrer_id:
-            percentage = Decimal(get_setting("referral_percentage") or "0")
-            
-            reward = (Decimal(str(price)) * percentage / 100).quantize(Decimal("0.01"))
-            
-            if float(reward) > 0:
-                add_to_referral_balance(referrer_id, float(reward))
-                
-                try:
-                    referrer_username = user_data.get('username', 'пользователь')
-                    await bot.send_message(
-                        referrer_id,
-                        f"🎉 Ваш реферал @{referrer_username} совершил покупку на сумму {price:.2f} RUB!\n"
-                        f"💰 На ваш баланс начислено вознаграждение: {reward:.2f} RUB."
-                    )
-                except Exception as e:
-                    logger.warning(f"Could not send referral reward notification to {referrer_id}: {e}")
+        record = await aio.record_successful_payment(
+            user_id=user_id,
+            action=action,
+            key_id=key_id,
+            host_name=host_name,
+            client_uuid=result['client_uuid'],
+            key_email=result['email'],
+            expiry_timestamp_ms=result['expiry_timestamp_ms'],
+            months=months,
+            price=price,
+            payment_method=payment_method,
+            plan_id=plan_id,
+            customer_email=customer_email,
+            referral_percentage=Decimal(get_setting("referral_percentage") or "0")
+        )
 
-        update_user_stats(user_id, price, months)
-        
-        user_info = get_user(user_id)
+        if not record:
+            await processing_message.edit_text("❌ Не удалось сохранить данные об оплате. Обратитесь в поддержку.")
+            return
 
-        internal_payment_id = str(uuid.uuid4())
-        
-        log_username = user_info.get('username', 'N/A') if user_info else 'N/A'
-        log_status = 'paid'
-        log_amount_rub = float(price)
-        log_method = metadata.get('payment_method', 'Unknown')
-        
-        log_metadata = json.dumps({
-            "plan_id": metadata.get('plan_id'),
-            "plan_name": get_plan_by_id(metadata.get('plan_id')).get('plan_name', 'Unknown') if get_plan_by_id(metadata.get('plan_id')) else 'Unknown',
-            "host_name": metadata.get('host_name'),
-            "customer_email": metadata.get('customer_email')
-        })
+        key_id = record['key_id']
+        referrer_id = record['referrer_id']
+        reward = record['referral_reward']
 
-        log_transaction(
-            username=log_username,
-            transaction_id=None,
-            payment_id=internal_payment_id,
-            user_id=user_id,
-            status=log_status,
-            amount_rub=log_amount_rub,
-            amount_currency=None,
-            currency_name=None,
-            payment_method=log_method,
-            metadata=log_metadata
-        )
+        if referrer_id and reward > 0:
+            try:
+                referrer_username = record['username'] or 'пользователь'
+                await bot.send_message(
+                    referrer_id,
+                    f"🎉 Ваш реферал @{referrer_username} совершил покупку на сумму {price:.2f} RUB!\n"
+                    f"💰 На ваш баланс начислено вознаграждение: {reward:.2f} RUB."
+                )
+            except Exception as e:
+                logger.warning(f"Could not send referral reward notification to {referrer_id}: {e}")
         
         await processing_message.delete()
         
         connection_string = result['connection_string']
         new_expiry_date = datetime.fromtimestamp(result['expiry_timestamp_ms'] / 1000)
-        
-        all_user_keys = get_user_keys(user_id)
-        key_number = next((i + 1 for i, key in enumerate(all_user_keys) if key['key_id'] == key_id), len(all_user_keys))
+        key_number = record['key_number']
 
         final_text = get_purchase_success_text(
             action="создан" if action == "new" else "продлен",
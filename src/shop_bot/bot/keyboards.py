@@ -6,6 +6,7 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMar
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shop_bot.data_manager.database import get_setting
+from shop_bot.modules import host_health
 
 logger = logging.getLogger(__name__)
 
@@ -101,6 +102,9 @@ def create_news_channel_keyboard(channel_url: str) -> InlineKeyboardMarkup:
 def create_host_selection_keyboard(hosts: list, action: str) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     for host in hosts:
+        if host_health.is_down(host['host_name']):
+            builder.button(text=f"⛔ {host['host_name']} (временно недоступен)", callback_data="host_unavailable")
+            continue
         callback_data = f"select_host_{action}_{host['host_name']}"
         builder.button(text=host['host_name'], callback_data=callback_data)
     builder.button(text="⬅️ Назад", callback_data="manage_keys" if action == 'new' else "back_to_main_menu")
@@ -176,9 +180,10 @@ def create_admin_document_keyboard(document_id: int, transaction_id: int) -> Inl
 def create_keys_management_keyboard(keys: list) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
     if keys:
+        now_ms = int(datetime.now().timestamp() * 1000)
         for i, key in enumerate(keys):
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            status_icon = "✅" if expiry_date > datetime.now() else "❌"
+            expiry_date = datetime.fromtimestamp(key['expiry_ms'] / 1000)
+            status_icon = "✅" if key['expiry_ms'] > now_ms else "❌"
             host_name = key.get('host_name', 'Неизвестный хост')
             button_text = f"{status_icon} Ключ #{i+1} ({host_name}) (до {expiry_date.strftime('%d.%m.%Y')})"
             builder.button(text=button_text, callback_data=f"show_key_{key['key_id']}")
@@ -1,7 +1,7 @@
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject, Message, CallbackQuery, Chat
-from shop_bot.data_manager.database import get_user
+from shop_bot.data_manager.database import aio
 
 class BanMiddleware(BaseMiddleware):
     async def __call__(
@@ -14,7 +14,7 @@ class BanMiddleware(BaseMiddleware):
         if not user:
             return await handler(event, data)
 
-        user_data = get_user(user.id)
+        user_data = await aio.get_user(user.id)
         if user_data and user_data.get('is_banned'):
             ban_message_text = "Вы заблокированы и не можете использовать этого бота."
             if isinstance(event, CallbackQuery):
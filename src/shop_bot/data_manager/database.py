@@ -1,150 +1,420 @@
 import sqlite3
 from datetime import datetime
+from decimal import Decimal
 import logging
 from pathlib import Path
 import json
+import uuid
+import queue
+import threading
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
 PROJECT_ROOT = Path("/app/project")
 DB_FILE = PROJECT_ROOT / "users.db"
 
+DB_POOL_SIZE = 8
+DB_POOL_ACQUIRE_TIMEOUT = 30
+
+# Профиль хранения: WAL позволяет читателям не ждать писателей, остальные
+# параметры применяются к каждому соединению пула.
+DB_JOURNAL_MODE = "WAL"
+STORAGE_PROFILE = {
+    "busy_timeout": 5000,
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+def apply_storage_profile(conn: sqlite3.Connection):
+    for pragma, value in STORAGE_PROFILE.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+class ConnectionPool:
+    """Пул долгоживущих соединений с users.db, общий для бота, веб-панели и планировщика.
+
+    Соединение закрепляется за потоком на время блока `with`, поэтому вложенные
+    вызовы функций модуля используют то же соединение. Выход из внешнего блока
+    фиксирует транзакцию (или откатывает её при исключении) и возвращает соединение в пул.
+    Если исключение прошло через вложенный блок, транзакция помечается на откат: даже когда
+    вызывающий код его перехватил, внешний блок откатывает изменения и поднимает ошибку.
+    """
+
+    def __init__(self, size: int = DB_POOL_SIZE):
+        self._size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        apply_storage_profile(conn)
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_open = self._created < self._size
+            if can_open:
+                self._created += 1
+        if can_open:
+            try:
+                return self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a free database connection")
+
+    def _release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, immediate: bool = False):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            try:
+                yield conn
+            except BaseException:
+                self._local.rollback_only = True
+                raise
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        self._local.rollback_only = False
+        try:
+            if immediate:
+                conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            if self._local.rollback_only:
+                raise sqlite3.OperationalError("Transaction rolled back after an error in a nested operation")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._local.conn = None
+            self._local.rollback_only = False
+            self._release(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+_pool = ConnectionPool()
+
+def get_connection():
+    return _pool.connection()
+
+def transaction():
+    """Единица работы: все вызовы функций модуля внутри блока попадают в одну транзакцию.
+
+    Блокировка на запись берётся сразу (BEGIN IMMEDIATE), фиксация — одна, при выходе из блока.
+    """
+    return _pool.connection(immediate=True)
+
+def close_connections():
+    _executor.shutdown(wait=False)
+    _settings_cache.close()
+    _pool.close_all()
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+class AsyncDatabase:
+    """Асинхронный фасад модуля: `await aio.get_user(...)` выполняет одноимённую функцию
+    в отдельном пуле потоков и не блокирует цикл событий бота."""
+
+    def __getattr__(self, name: str):
+        if name.startswith("_") or not callable(globals().get(name)):
+            raise AttributeError(f"database has no function '{name}'")
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, functools.partial(globals()[name], *args, **kwargs))
+
+        call.__name__ = name
+        setattr(self, name, call)
+        return call
+
+aio = AsyncDatabase()
+
+# Биты vpn_keys.notified_marks: какие напоминания об окончании ключа (за N часов) уже отправлены.
+NOTIFY_MARK_BITS = {1: 1 << 0, 24: 1 << 1, 48: 1 << 2, 72: 1 << 3}
+
+def _reached_marks(expiry_ms: int) -> int:
+    """Биты отметок, время которых для срока expiry_ms уже наступило.
+
+    Ставятся при выдаче или продлении ключа: о трёхдневном пробном ключе не напоминаем «осталось 3 дня» сразу после выдачи.
+    """
+    now_ms = int(time.time() * 1000)
+    return sum(bit for hours_mark, bit in NOTIFY_MARK_BITS.items() if expiry_ms - hours_mark * 3600 * 1000 <= now_ms)
+
+# Подписчики на изменения сроков ключей. Слушатель получает список (key_id, expiry_ms)
+# или None, если изменился неизвестный набор ключей. Вызывается в потоке, выполнившем запись.
+_key_listeners = []
+
+def add_key_listener(listener):
+    _key_listeners.append(listener)
+
+def remove_key_listener(listener):
+    if listener in _key_listeners:
+        _key_listeners.remove(listener)
+
+def _emit_key_changes(changes: list[tuple[int, int]] | None):
+    for listener in list(_key_listeners):
+        try:
+            listener(changes)
+        except Exception as e:
+            logging.error(f"Key change listener failed: {e}")
+
+# Подписчики на изменения хостов (создание, удаление); слушатель получает host_name.
+_host_listeners = []
+
+def add_host_listener(listener):
+    _host_listeners.append(listener)
+
+def _emit_host_change(host_name: str):
+    for listener in list(_host_listeners):
+        try:
+            listener(host_name)
+        except Exception as e:
+            logging.error(f"Host change listener failed: {e}")
+
+SETTINGS_CACHE_CHECK_INTERVAL = 1.0
+
+class SettingsCache:
+    """Кэш таблицы bot_settings в памяти.
+
+    Записи через update_setting сбрасывают кэш сразу. Изменения из других соединений
+    и процессов замечаются по PRAGMA data_version отдельного соединения-наблюдателя,
+    которое опрашивается не чаще раза в SETTINGS_CACHE_CHECK_INTERVAL секунд.
+    """
+
+    def __init__(self):
+        self._values = None
+        self._lock = threading.Lock()
+        self._watch_conn = None
+        self._data_version = None
+        self._checked_at = 0.0
+
+    def _read_data_version(self) -> int:
+        if self._watch_conn is None:
+            self._watch_conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        return self._watch_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if self._values is not None and now - self._checked_at < SETTINGS_CACHE_CHECK_INTERVAL:
+                return self._values
+
+            data_version = self._read_data_version()
+            self._checked_at = now
+            if self._values is None or data_version != self._data_version:
+                self._values = _load_all_settings()
+                self._data_version = data_version
+            return self._values
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+    def close(self):
+        with self._lock:
+            self._values = None
+            if self._watch_conn is not None:
+                self._watch_conn.close()
+                self._watch_conn = None
+
+_settings_cache = SettingsCache()
+
+def checkpoint_wal(mode: str = "TRUNCATE") -> tuple[int, int, int] | None:
+    try:
+        with get_connection() as conn:
+            busy, log_frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+            return busy, log_frames, checkpointed
+    except sqlite3.Error as e:
+        logging.error(f"Failed to checkpoint WAL: {e}")
+        return None
+
 def initialize_db():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
-                    total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
-                    agreed_to_terms BOOLEAN DEFAULT 0,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT 0,
-                    referred_by INTEGER,
-                    referral_balance REAL DEFAULT 0,
-                    referral_balance_all REAL DEFAULT 0
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS vpn_keys (
-                    key_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    host_name TEXT NOT NULL,
-                    xui_client_uuid TEXT NOT NULL,
-                    key_email TEXT NOT NULL UNIQUE,
-                    expiry_date TIMESTAMP,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS transactions (
-                    username TEXT,
-                    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    payment_id TEXT UNIQUE NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    amount_rub REAL NOT NULL,
-                    amount_currency REAL,
-                    currency_name TEXT,
-                    payment_method TEXT,
-                    metadata TEXT,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS bot_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS support_threads (
-                    user_id INTEGER PRIMARY KEY,
-                    thread_id INTEGER NOT NULL
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS xui_hosts(
-                    host_name TEXT NOT NULL,
-                    host_url TEXT NOT NULL,
-                    host_username TEXT NOT NULL,
-                    host_pass TEXT NOT NULL,
-                    host_inbound_id INTEGER NOT NULL
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS plans (
-                    plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    plan_name TEXT NOT NULL,
-                    months INTEGER NOT NULL,
-                    price REAL NOT NULL,
-                    FOREIGN KEY (host_name) REFERENCES xui_hosts (host_name)
-                )
-            ''')
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS bank_payment_documents (
-                    document_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    transaction_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    file_id TEXT NOT NULL,
-                    file_type TEXT NOT NULL,
-                    status TEXT NOT NULL DEFAULT 'pending',
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    reviewed_date TIMESTAMP,
-                    reviewed_by INTEGER,
-                    FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id)
-                )
-            ''')            
-            default_settings = {
-                "panel_login": "admin",
-                "panel_password": "admin",
-                "about_text": None,
-                "terms_url": None,
-                "privacy_url": None,
-                "support_user": None,
-                "support_text": None,
-                "channel_url": None,
-                "force_subscription": "true",
-                "receipt_email": "example@example.com",
-                "telegram_bot_token": None,
-                "support_bot_token": None,
-                "telegram_bot_username": None,
-                "trial_enabled": "true",
-                "trial_duration_days": "3",
-                "enable_referrals": "true",
-                "referral_percentage": "10",
-                "referral_discount": "5",
-                "minimum_withdrawal": "100",
-                "support_group_id": None,
-                "admin_telegram_id": None,
-                "yookassa_shop_id": None,
-                "yookassa_secret_key": None,
-                "sbp_enabled": "false",
-                "cryptobot_token": None,
-                "heleket_merchant_id": None,
-                "heleket_api_key": None,
-                "domain": None,
-                "ton_wallet_address": None,
-                "tonapi_key": None,
-                "bank_card_rf_details": None,
-                "welcome_message_text": None,
-                "welcome_message_photo_path": None,
-                "support_telegram_url": None,
-                "news_channel_url": None,
-                "android_url": "https://telegra.ph/Instrukciya-Android-11-09",
-                "windows_url": "https://telegra.ph/Instrukciya-Windows-11-09",
-                "ios_url": "https://telegra.ph/Instrukcii-ios-11-09",
-                "linux_url": "https://telegra.ph/Instrukciya-Linux-11-09",
-            }
-            run_migration()
-            for key, value in default_settings.items():
-                cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-            conn.commit()
+        with get_connection() as conn:
+            current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current_version >= SCHEMA_VERSION:
+                logging.info(f"Database schema is up to date (version {current_version}).")
+                return
+
+            cursor = conn.cursor()
+            journal_mode = cursor.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}").fetchone()[0]
+            if journal_mode.upper() != DB_JOURNAL_MODE:
+                logging.warning(f"Could not switch database to {DB_JOURNAL_MODE} mode, current mode is '{journal_mode}'.")
+            if current_version == 0:
+                _create_baseline_schema(cursor)
+            apply_schema_migrations(conn)
             logging.info("Database initialized successfully.")
     except sqlite3.Error as e:
         logging.error(f"Database error on initialization: {e}")
 
+def _create_baseline_schema(cursor: sqlite3.Cursor):
+    """Исходная схема и настройки по умолчанию; выполняется только для базы с user_version = 0.
+
+    Новые таблицы, колонки и настройки добавляются отдельными шагами в SCHEMA_MIGRATIONS.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
+            total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
+            agreed_to_terms BOOLEAN DEFAULT 0,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_banned BOOLEAN DEFAULT 0,
+            referred_by INTEGER,
+            referral_balance REAL DEFAULT 0,
+            referral_balance_all REAL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vpn_keys (
+            key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            host_name TEXT NOT NULL,
+            xui_client_uuid TEXT NOT NULL,
+            key_email TEXT NOT NULL UNIQUE,
+            expiry_date TIMESTAMP,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            username TEXT,
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payment_id TEXT UNIQUE NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            amount_rub REAL NOT NULL,
+            amount_currency REAL,
+            currency_name TEXT,
+            payment_method TEXT,
+            metadata TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS support_threads (
+            user_id INTEGER PRIMARY KEY,
+            thread_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS xui_hosts(
+            host_name TEXT NOT NULL,
+            host_url TEXT NOT NULL,
+            host_username TEXT NOT NULL,
+            host_pass TEXT NOT NULL,
+            host_inbound_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS plans (
+            plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            host_name TEXT NOT NULL,
+            plan_name TEXT NOT NULL,
+            months INTEGER NOT NULL,
+            price REAL NOT NULL,
+            FOREIGN KEY (host_name) REFERENCES xui_hosts (host_name)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bank_payment_documents (
+            document_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            file_type TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            reviewed_date TIMESTAMP,
+            reviewed_by INTEGER,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (transaction_id)
+        )
+    ''')
+    default_settings = {
+        "panel_login": "admin",
+        "panel_password": "admin",
+        "about_text": None,
+        "terms_url": None,
+        "privacy_url": None,
+        "support_user": None,
+        "support_text": None,
+        "channel_url": None,
+        "force_subscription": "true",
+        "receipt_email": "example@example.com",
+        "telegram_bot_token": None,
+        "support_bot_token": None,
+        "telegram_bot_username": None,
+        "trial_enabled": "true",
+        "trial_duration_days": "3",
+        "enable_referrals": "true",
+        "referral_percentage": "10",
+        "referral_discount": "5",
+        "minimum_withdrawal": "100",
+        "support_group_id": None,
+        "admin_telegram_id": None,
+        "yookassa_shop_id": None,
+        "yookassa_secret_key": None,
+        "sbp_enabled": "false",
+        "cryptobot_token": None,
+        "heleket_merchant_id": None,
+        "heleket_api_key": None,
+        "domain": None,
+        "ton_wallet_address": None,
+        "tonapi_key": None,
+        "bank_card_rf_details": None,
+        "welcome_message_text": None,
+        "welcome_message_photo_path": None,
+        "support_telegram_url": None,
+        "news_channel_url": None,
+        "android_url": "https://telegra.ph/Instrukciya-Android-11-09",
+        "windows_url": "https://telegra.ph/Instrukciya-Windows-11-09",
+        "ios_url": "https://telegra.ph/Instrukcii-ios-11-09",
+        "linux_url": "https://telegra.ph/Instrukciya-Linux-11-09",
+    }
+    run_migration()
+    for key, value in default_settings.items():
+        cursor.execute("INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
+    cursor.connection.commit()
+
 def run_migration():
     if not DB_FILE.exists():
         logging.error("Users.db database file was not found. There is nothing to migrate.")
@@ -153,61 +423,58 @@ def run_migration():
     logging.info(f"Starting the migration of the database: {DB_FILE}")
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        with get_connection() as conn:
+            cursor = conn.cursor()
 
-        logging.info("The migration of the table 'users' ...")
+            logging.info("The migration of the table 'users' ...")
     
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [row[1] for row in cursor.fetchall()]
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [row[1] for row in cursor.fetchall()]
         
-        if 'referred_by' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
-            logging.info(" -> The column 'referred_by' is successfully added.")
-        else:
-            logging.info(" -> The column 'referred_by' already exists.")
+            if 'referred_by' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
+                logging.info(" -> The column 'referred_by' is successfully added.")
+            else:
+                logging.info(" -> The column 'referred_by' already exists.")
             
-        if 'referral_balance' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
-            logging.info(" -> The column 'referral_balance' is successfully added.")
-        else:
-            logging.info(" -> The column 'referral_balance' already exists.")
+            if 'referral_balance' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN referral_balance REAL DEFAULT 0")
+                logging.info(" -> The column 'referral_balance' is successfully added.")
+            else:
+                logging.info(" -> The column 'referral_balance' already exists.")
         
-        if 'referral_balance_all' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN referral_balance_all REAL DEFAULT 0")
-            logging.info(" -> The column 'referral_balance_all' is successfully added.")
-        else:
-            logging.info(" -> The column 'referral_balance_all' already exists.")
+            if 'referral_balance_all' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN referral_balance_all REAL DEFAULT 0")
+                logging.info(" -> The column 'referral_balance_all' is successfully added.")
+            else:
+                logging.info(" -> The column 'referral_balance_all' already exists.")
         
-        logging.info("The table 'users' has been successfully updated.")
+            logging.info("The table 'users' has been successfully updated.")
 
-        logging.info("The migration of the table 'Transactions' ...")
+            logging.info("The migration of the table 'Transactions' ...")
 
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
-        table_exists = cursor.fetchone()
+            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
+            table_exists = cursor.fetchone()
 
-        if table_exists:
-            cursor.execute("PRAGMA table_info(transactions)")
-            trans_columns = [row[1] for row in cursor.fetchall()]
+            if table_exists:
+                cursor.execute("PRAGMA table_info(transactions)")
+                trans_columns = [row[1] for row in cursor.fetchall()]
             
-            if 'payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns:
-                logging.info("The 'Transactions' table already has a new structure. Migration is not required.")
-            else:
-                backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-                logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
-                cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
+                if 'payment_id' in trans_columns and 'status' in trans_columns and 'username' in trans_columns:
+                    logging.info("The 'Transactions' table already has a new structure. Migration is not required.")
+                else:
+                    backup_name = f"transactions_backup_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+                    logging.warning(f"The old structure of the TRANSACTIONS table was discovered. I rename in '{backup_name}' ...")
+                    cursor.execute(f"ALTER TABLE transactions RENAME TO {backup_name}")
                 
-                logging.info("I create a new table 'Transactions' with the correct structure ...")
+                    logging.info("I create a new table 'Transactions' with the correct structure ...")
+                    create_new_transactions_table(cursor)
+                    logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
+            else:
+                logging.info("TRANSACTIONS table was not found. I create a new one ...")
                 create_new_transactions_table(cursor)
-                logging.info("The new table 'Transactions' has been successfully created. The old data is saved.")
-        else:
-            logging.info("TRANSACTIONS table was not found. I create a new one ...")
-            create_new_transactions_table(cursor)
-            logging.info("The new table 'Transactions' has been successfully created.")
+                logging.info("The new table 'Transactions' has been successfully created.")
 
-        conn.commit()
-        conn.close()
-        
         logging.info("--- The database is successfully completed! ---")
 
     except sqlite3.Error as e:
@@ -230,34 +497,279 @@ def create_new_transactions_table(cursor: sqlite3.Cursor):
         )
     ''')
 
+MIGRATION_BATCH_SIZE = 5000
+
+def _run_batched_migration(cursor: sqlite3.Cursor, name: str, table: str, key_column: str, update_sql: str, batch_size: int = MIGRATION_BATCH_SIZE):
+    """Выполняет update_sql пачками по диапазонам key_column, фиксируя каждую пачку вместе с прогрессом.
+
+    update_sql принимает границы диапазона (start, end]. После перезапуска процесса миграция
+    продолжается с последней зафиксированной пачки.
+    """
+    cursor.execute("CREATE TABLE IF NOT EXISTS migration_progress (name TEXT PRIMARY KEY, last_key INTEGER NOT NULL)")
+    row = cursor.execute("SELECT last_key FROM migration_progress WHERE name = ?", (name,)).fetchone()
+    start = row[0] if row else 0
+    if start:
+        logging.info(f" -> Resuming batched migration '{name}' after {key_column} {start}.")
+    max_key = cursor.execute(f"SELECT COALESCE(MAX({key_column}), 0) FROM {table}").fetchone()[0]
+    while start < max_key:
+        end = start + batch_size
+        cursor.execute(update_sql, (start, end))
+        cursor.execute("INSERT OR REPLACE INTO migration_progress (name, last_key) VALUES (?, ?)", (name, end))
+        cursor.connection.commit()
+        start = end
+    cursor.execute("DELETE FROM migration_progress WHERE name = ?", (name,))
+
+def _migration_lookup_indexes(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys (user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_name ON vpn_keys (host_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_created_date ON vpn_keys (created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by, registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions (user_id, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_threads_thread_id ON support_threads (thread_id)")
+
+def _migration_transactions_keyset(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created_id ON transactions (created_date, transaction_id)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("INSERT OR REPLACE INTO stats (name, value) VALUES ('transactions_count', (SELECT COUNT(*) FROM transactions))")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_insert AFTER INSERT ON transactions
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = 'transactions_count';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_transactions_count_delete AFTER DELETE ON transactions
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = 'transactions_count';
+        END
+    """)
+
+# Счётчики дашборда и запросы, по которым они пересчитываются с нуля.
+STATS_QUERIES = {
+    'transactions_count': "SELECT COUNT(*) FROM transactions",
+    'users_count': "SELECT COUNT(*) FROM users",
+    'users_total_spent': "SELECT COALESCE(SUM(total_spent), 0) FROM users",
+    'keys_count': "SELECT COUNT(*) FROM vpn_keys",
+    'hosts_count': "SELECT COUNT(*) FROM xui_hosts",
+}
+
+def _migration_dashboard_counters(cursor: sqlite3.Cursor):
+    for name in ('users_count', 'users_total_spent', 'keys_count', 'hosts_count'):
+        cursor.execute(f"INSERT OR REPLACE INTO stats (name, value) VALUES (?, ({STATS_QUERIES[name]}))", (name,))
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = 'users_count';
+            UPDATE stats SET value = value + COALESCE(NEW.total_spent, 0) WHERE name = 'users_total_spent';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = 'users_count';
+            UPDATE stats SET value = value - COALESCE(OLD.total_spent, 0) WHERE name = 'users_total_spent';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_stats_spent AFTER UPDATE OF total_spent ON users
+        BEGIN
+            UPDATE stats SET value = value + COALESCE(NEW.total_spent, 0) - COALESCE(OLD.total_spent, 0) WHERE name = 'users_total_spent';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_insert AFTER INSERT ON vpn_keys
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = 'keys_count';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_count_delete AFTER DELETE ON vpn_keys
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = 'keys_count';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_xui_hosts_count_insert AFTER INSERT ON xui_hosts
+        BEGIN
+            UPDATE stats SET value = value + 1 WHERE name = 'hosts_count';
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_xui_hosts_count_delete AFTER DELETE ON xui_hosts
+        BEGIN
+            UPDATE stats SET value = value - 1 WHERE name = 'hosts_count';
+        END
+    """)
+
+TRANSACTION_METADATA_COLUMNS = {
+    'host_name': 'TEXT',
+    'plan_id': 'INTEGER',
+    'plan_name': 'TEXT',
+    'months': 'INTEGER',
+    'customer_email': 'TEXT',
+}
+
+def _migration_transactions_metadata_columns(cursor: sqlite3.Cursor):
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(transactions)").fetchall()}
+    for column, column_type in TRANSACTION_METADATA_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE transactions ADD COLUMN {column} {column_type}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_host_name ON transactions (host_name, created_date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_plan_id ON transactions (plan_id, created_date)")
+
+    _run_batched_migration(cursor, "transactions_metadata_columns", "transactions", "transaction_id", """
+        UPDATE transactions SET
+            host_name = json_extract(metadata, '$.host_name'),
+            plan_id = json_extract(metadata, '$.plan_id'),
+            plan_name = COALESCE(
+                json_extract(metadata, '$.plan_name'),
+                (SELECT p.plan_name FROM plans p WHERE p.plan_id = json_extract(transactions.metadata, '$.plan_id'))
+            ),
+            months = json_extract(metadata, '$.months'),
+            customer_email = json_extract(metadata, '$.customer_email')
+        WHERE transaction_id > ? AND transaction_id <= ? AND json_valid(metadata)
+    """)
+
+def _migration_vpn_keys_expiry_ms(cursor: sqlite3.Cursor):
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(vpn_keys)").fetchall()}
+    if 'expiry_ms' not in existing:
+        cursor.execute("ALTER TABLE vpn_keys ADD COLUMN expiry_ms INTEGER")
+    # expiry_date хранится в локальном времени сервера (datetime.fromtimestamp), поэтому модификатор 'utc'.
+    _run_batched_migration(cursor, "vpn_keys_expiry_ms", "vpn_keys", "key_id", """
+        UPDATE vpn_keys SET expiry_ms = CAST(ROUND((julianday(expiry_date, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+        WHERE key_id > ? AND key_id <= ? AND expiry_date IS NOT NULL
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry_ms ON vpn_keys (expiry_ms)")
+
+def _migration_vpn_keys_notified_marks(cursor: sqlite3.Cursor):
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(vpn_keys)").fetchall()}
+    if 'notified_marks' not in existing:
+        cursor.execute("ALTER TABLE vpn_keys ADD COLUMN notified_marks INTEGER NOT NULL DEFAULT 0")
+
+# Параметры инбаунда, из которых строится vless-ссылка; обновляются планировщиком при синхронизации.
+HOST_REALITY_COLUMNS = {
+    'inbound_port': 'INTEGER',
+    'reality_public_key': 'TEXT',
+    'reality_fingerprint': 'TEXT',
+    'reality_server_name': 'TEXT',
+    'reality_short_id': 'TEXT',
+}
+
+def _migration_xui_hosts_reality_columns(cursor: sqlite3.Cursor):
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(xui_hosts)").fetchall()}
+    for column, column_type in HOST_REALITY_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE xui_hosts ADD COLUMN {column} {column_type}")
+
+# Части vless-ссылки хоста: ссылка ключа = link_prefix || xui_client_uuid || link_suffix.
+HOST_LINK_COLUMNS = {
+    'link_prefix': 'TEXT',
+    'link_suffix': 'TEXT',
+}
+
+def _migration_vpn_keys_connection_string(cursor: sqlite3.Cursor):
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(xui_hosts)").fetchall()}
+    for column, column_type in HOST_LINK_COLUMNS.items():
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE xui_hosts ADD COLUMN {column} {column_type}")
+    existing = {row[1] for row in cursor.execute("PRAGMA table_info(vpn_keys)").fetchall()}
+    if 'connection_string' not in existing:
+        cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_string TEXT")
+
+    # Ссылки ключей поддерживаются триггерами: при добавлении ключа, смене его uuid или хоста,
+    # и одним UPDATE по всем ключам хоста, когда меняются части ссылки хоста.
+    # Пока части ссылки не заполнены синхронизацией, connection_string остаётся NULL.
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_link_insert AFTER INSERT ON vpn_keys
+        BEGIN
+            UPDATE vpn_keys SET connection_string = (
+                SELECT link_prefix || NEW.xui_client_uuid || link_suffix FROM xui_hosts WHERE host_name = NEW.host_name
+            ) WHERE key_id = NEW.key_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_vpn_keys_link_update AFTER UPDATE OF xui_client_uuid, host_name ON vpn_keys
+        WHEN NEW.xui_client_uuid IS NOT OLD.xui_client_uuid OR NEW.host_name IS NOT OLD.host_name
+        BEGIN
+            UPDATE vpn_keys SET connection_string = (
+                SELECT link_prefix || NEW.xui_client_uuid || link_suffix FROM xui_hosts WHERE host_name = NEW.host_name
+            ) WHERE key_id = NEW.key_id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_xui_hosts_link_update AFTER UPDATE OF link_prefix, link_suffix ON xui_hosts
+        WHEN NEW.link_prefix IS NOT OLD.link_prefix OR NEW.link_suffix IS NOT OLD.link_suffix
+        BEGIN
+            UPDATE vpn_keys SET connection_string = NEW.link_prefix || xui_client_uuid || NEW.link_suffix
+            WHERE host_name = NEW.host_name;
+        END
+    """)
+
+def _migration_vpn_keys_host_expiry_index(cursor: sqlite3.Cursor):
+    # Проверка истёкших ключей хоста перед синхронизацией ищет по (host_name, expiry_ms) без обхода всех его ключей.
+    # Индекс покрывает и поиск по одному host_name, поэтому прежний одностолбцовый больше не нужен.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_host_expiry ON vpn_keys (host_name, expiry_ms)")
+    cursor.execute("DROP INDEX IF EXISTS idx_vpn_keys_host_name")
+
+# Версионированные миграции схемы: номер последней применённой хранится в PRAGMA user_version.
+SCHEMA_MIGRATIONS = [
+    (1, "secondary indexes for hot lookups", _migration_lookup_indexes),
+    (2, "keyset index and cached count for transactions", _migration_transactions_keyset),
+    (3, "trigger-maintained dashboard counters", _migration_dashboard_counters),
+    (4, "metadata fields as transactions columns", _migration_transactions_metadata_columns),
+    (5, "integer expiry_ms for vpn_keys", _migration_vpn_keys_expiry_ms),
+    (6, "persistent expiry notification marks for vpn_keys", _migration_vpn_keys_notified_marks),
+    (7, "cached inbound reality parameters for xui_hosts", _migration_xui_hosts_reality_columns),
+    (8, "stored connection strings for vpn_keys", _migration_vpn_keys_connection_string),
+    (9, "composite host and expiry index for vpn_keys", _migration_vpn_keys_host_expiry_index),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def apply_schema_migrations(conn: sqlite3.Connection):
+    current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, migrate in SCHEMA_MIGRATIONS:
+        if version <= current_version:
+            continue
+        logging.info(f"Applying schema migration {version}: {description} ...")
+        cursor = conn.cursor()
+        migrate(cursor)
+        cursor.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        logging.info(f" -> Schema migration {version} applied.")
+
 def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO xui_hosts (host_name, host_url, host_username, host_pass, host_inbound_id) VALUES (?, ?, ?, ?, ?)",
                 (name, url, user, passwd, inbound)
             )
-            conn.commit()
             logging.info(f"Successfully created a new host: {name}")
+        _emit_host_change(name)
     except sqlite3.Error as e:
         logging.error(f"Error creating host '{name}': {e}")
 
 def delete_host(host_name: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE host_name = ?", (host_name,))
             cursor.execute("DELETE FROM xui_hosts WHERE host_name = ?", (host_name,))
-            conn.commit()
             logging.info(f"Successfully deleted host '{host_name}' and its plans.")
+        _emit_host_change(host_name)
     except sqlite3.Error as e:
         logging.error(f"Error deleting host '{host_name}': {e}")
 
 def get_host(host_name: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE host_name = ?", (host_name,))
             result = cursor.fetchone()
@@ -266,10 +778,35 @@ def get_host(host_name: str) -> dict | None:
         logging.error(f"Error getting host '{host_name}': {e}")
         return None
 
+def update_host_reality_params(host_name: str, params: dict) -> bool:
+    """Сохраняет параметры reality и части ссылки хоста; возвращает True, если они изменились.
+
+    При изменении частей ссылки триггер перестраивает connection_string всех ключей хоста
+    в той же транзакции.
+    """
+    columns = [*HOST_REALITY_COLUMNS, *HOST_LINK_COLUMNS]
+    values = [params.get(column) for column in columns]
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"UPDATE xui_hosts SET {', '.join(f'{column} = ?' for column in columns)} "
+                f"WHERE host_name = ? AND ({' OR '.join(f'{column} IS NOT ?' for column in columns)})",
+                (*values, host_name, *values)
+            )
+            changed = cursor.rowcount > 0
+            if changed:
+                keys_count = cursor.execute("SELECT COUNT(*) FROM vpn_keys WHERE host_name = ?", (host_name,)).fetchone()[0]
+        if changed:
+            logging.info(f"Reality parameters of host '{host_name}' updated, connection strings of {keys_count} keys regenerated.")
+        return changed
+    except sqlite3.Error as e:
+        logging.error(f"Error updating reality parameters for host '{host_name}': {e}")
+        return False
+
 def get_all_hosts() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts")
             hosts = cursor.fetchall()
@@ -280,8 +817,7 @@ def get_all_hosts() -> list[dict]:
 
 def get_all_keys() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys")
             return [dict(row) for row in cursor.fetchall()]
@@ -289,58 +825,52 @@ def get_all_keys() -> list[dict]:
         logging.error(f"Failed to get all keys: {e}")
         return []
 
+def _load_all_settings() -> dict:
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT key, value FROM bot_settings")
+        return {row['key']: row['value'] for row in cursor.fetchall()}
+
 def get_setting(key: str) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+        return _settings_cache.snapshot().get(key)
     except sqlite3.Error as e:
         logging.error(f"Failed to get setting '{key}': {e}")
         return None
         
 def get_all_settings() -> dict:
-    settings = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM bot_settings")
-            rows = cursor.fetchall()
-            for row in rows:
-                settings[row['key']] = row['value']
+        return dict(_settings_cache.snapshot())
     except sqlite3.Error as e:
         logging.error(f"Failed to get all settings: {e}")
-    return settings
+        return {}
 
 def update_setting(key: str, value: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)", (key, value))
-            conn.commit()
             logging.info(f"Setting '{key}' updated.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
+    finally:
+        _settings_cache.invalidate()
 
 def create_plan(host_name: str, plan_name: str, months: int, price: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price) VALUES (?, ?, ?, ?)",
                 (host_name, plan_name, months, price)
             )
-            conn.commit()
             logging.info(f"Created new plan '{plan_name}' for host '{host_name}'.")
     except sqlite3.Error as e:
         logging.error(f"Failed to create plan for host '{host_name}': {e}")
 
 def get_plans_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE host_name = ? ORDER BY months", (host_name,))
             plans = cursor.fetchall()
@@ -351,8 +881,7 @@ def get_plans_for_host(host_name: str) -> list[dict]:
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
             plan = cursor.fetchone()
@@ -363,17 +892,16 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
-            conn.commit()
             logging.info(f"Deleted plan with id {plan_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to delete plan with id {plan_id}: {e}")
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = ?", (telegram_id,))
             if not cursor.fetchone():
@@ -383,40 +911,36 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
                 )
             else:
                 cursor.execute("UPDATE users SET username = ? WHERE telegram_id = ?", (username, telegram_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
 
 def add_to_referral_balance(user_id: int, amount: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = referral_balance + ? WHERE telegram_id = ?", (amount, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to add to referral balance for user {user_id}: {e}")
 
 def set_referral_balance(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance = ? WHERE telegram_id = ?", (value, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to set referral balance for user {user_id}: {e}")
 
 def set_referral_balance_all(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?", (value, user_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to set total referral balance for user {user_id}: {e}")
 
 def get_referral_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -427,7 +951,7 @@ def get_referral_balance(user_id: int) -> float:
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
             return cursor.fetchone()[0] or 0
@@ -438,8 +962,7 @@ def get_referral_count(user_id: int) -> int:
 def get_user_referrals(user_id: int) -> list[dict]:
     """Получает список всех рефералов пользователя с их ID и username"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT telegram_id, username FROM users WHERE referred_by = ? ORDER BY registration_date DESC", (user_id,))
             referrals = cursor.fetchall()
@@ -450,8 +973,7 @@ def get_user_referrals(user_id: int) -> list[dict]:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
             user_data = cursor.fetchone()
@@ -462,62 +984,47 @@ def get_user(telegram_id: int):
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
             logging.info(f"User {telegram_id} has agreed to terms.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set terms agreed for user {telegram_id}: {e}")
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?", (amount_spent, months_purchased, telegram_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update user stats for {telegram_id}: {e}")
 
 def get_user_count() -> int:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM users")
-            return cursor.fetchone()[0] or 0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get user count: {e}")
-        return 0
+    return int(get_stat('users_count'))
 
 def get_total_keys_count() -> int:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM vpn_keys")
-            return cursor.fetchone()[0] or 0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get total keys count: {e}")
-        return 0
+    return int(get_stat('keys_count'))
 
 def get_total_spent_sum() -> float:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT SUM(total_spent) FROM users")
-            return cursor.fetchone()[0] or 0.0
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get total spent sum: {e}")
-        return 0.0
+    return get_stat('users_total_spent')
+
+def get_host_count() -> int:
+    return int(get_stat('hosts_count'))
+
+def _transaction_metadata_values(metadata: dict) -> tuple:
+    return tuple(metadata.get(column) for column in TRANSACTION_METADATA_COLUMNS)
 
 def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float, metadata: dict) -> int:
+    host_name, plan_id, plan_name, months, customer_email = _transaction_metadata_values(metadata)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO transactions (payment_id, user_id, status, amount_rub, metadata) VALUES (?, ?, ?, ?, ?)",
-                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata))
+                """INSERT INTO transactions
+                   (payment_id, user_id, status, amount_rub, metadata, host_name, plan_id, plan_name, months, customer_email)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, (SELECT plan_name FROM plans WHERE plan_id = ?)), ?, ?)""",
+                (payment_id, user_id, 'pending', amount_rub, json.dumps(metadata), host_name, plan_id, plan_name, plan_id, months, customer_email)
             )
-            conn.commit()
             return cursor.lastrowid
     except sqlite3.Error as e:
         logging.error(f"Failed to create pending transaction: {e}")
@@ -525,8 +1032,7 @@ def create_pending_transaction(payment_id: str, user_id: int, amount_rub: float,
 
 def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             
             cursor.execute("SELECT * FROM transactions WHERE payment_id = ? AND status = 'pending'", (payment_id,))
@@ -540,104 +1046,211 @@ def find_and_complete_ton_transaction(payment_id: str, amount_ton: float) -> dic
                 "UPDATE transactions SET status = 'paid', amount_currency = ?, currency_name = 'TON', payment_method = 'TON' WHERE payment_id = ?",
                 (amount_ton, payment_id)
             )
-            conn.commit()
             
             return json.loads(transaction['metadata'])
     except sqlite3.Error as e:
         logging.error(f"Failed to complete TON transaction {payment_id}: {e}")
         return None
 
-def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: str):
+def log_transaction(username: str, transaction_id: str | None, payment_id: str | None, user_id: int, status: str, amount_rub: float, amount_currency: float | None, currency_name: str | None, payment_method: str, metadata: dict):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """INSERT INTO transactions
-                   (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, created_date)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, datetime.now())
+                   (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, metadata, created_date,
+                    host_name, plan_id, plan_name, months, customer_email)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (username, transaction_id, payment_id, user_id, status, amount_rub, amount_currency, currency_name, payment_method, json.dumps(metadata), datetime.now(),
+                 *_transaction_metadata_values(metadata))
             )
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to log transaction for user {user_id}: {e}")
 
-def get_paginated_transactions(page: int = 1, per_page: int = 15) -> tuple[list[dict], int]:
-    offset = (page - 1) * per_page
+def get_stat(name: str) -> float:
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM stats WHERE name = ?", (name,))
+            result = cursor.fetchone()
+            return result[0] if result else 0
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get stat '{name}': {e}")
+        return 0
+
+def get_transactions_count() -> int:
+    return int(get_stat('transactions_count'))
+
+def rebuild_stats() -> dict:
+    """Пересчитывает счётчики с нуля и возвращает найденные расхождения {name: (было, стало)}."""
+    drift = {}
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            if not conn.in_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
+            for name, query in STATS_QUERIES.items():
+                actual = cursor.execute(query).fetchone()[0] or 0
+                row = cursor.execute("SELECT value FROM stats WHERE name = ?", (name,)).fetchone()
+                cached = row[0] if row else None
+                if cached is None or abs(cached - actual) > 1e-6:
+                    drift[name] = (cached, actual)
+                    cursor.execute("INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)", (name, actual))
+        if drift:
+            logging.warning(f"Dashboard counters drifted and were rebuilt: {drift}")
+    except sqlite3.Error as e:
+        logging.error(f"Failed to rebuild stats: {e}")
+    return drift
+
+def get_transactions_page(per_page: int = 15, after: int | None = None, before: int | None = None) -> tuple[list[dict], int | None, int | None]:
+    """Страница транзакций от новых к старым с курсорами по (created_date, transaction_id).
+
+    after — transaction_id последней строки предыдущей страницы (листаем к более старым),
+    before — transaction_id первой строки следующей страницы (листаем к более новым).
+    Возвращает (транзакции, курсор следующей страницы, курсор предыдущей страницы).
+    """
     transactions = []
-    total = 0
+    next_cursor = None
+    prev_cursor = None
+    cursor_row = "(SELECT created_date, transaction_id FROM transactions WHERE transaction_id = ?)"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
-            
-            cursor.execute("SELECT COUNT(*) FROM transactions")
-            total = cursor.fetchone()[0]
 
-            query = "SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?"
-            cursor.execute(query, (per_page, offset))
-            
-            for row in cursor.fetchall():
-                transaction_dict = dict(row)
-                
-                metadata_str = transaction_dict.get('metadata')
-                if metadata_str:
-                    try:
-                        metadata = json.loads(metadata_str)
-                        transaction_dict['host_name'] = metadata.get('host_name', 'N/A')
-                        transaction_dict['plan_name'] = metadata.get('plan_name', 'N/A')
-                    except json.JSONDecodeError:
-                        transaction_dict['host_name'] = 'Error'
-                        transaction_dict['plan_name'] = 'Error'
+            if before is not None:
+                cursor.execute(
+                    f"SELECT * FROM transactions WHERE (created_date, transaction_id) > {cursor_row} "
+                    "ORDER BY created_date ASC, transaction_id ASC LIMIT ?",
+                    (before, per_page + 1)
+                )
+                rows = cursor.fetchall()
+                has_newer = len(rows) > per_page
+                rows = list(reversed(rows[:per_page]))
+                has_older = True
+            else:
+                if after is not None:
+                    cursor.execute(
+                        f"SELECT * FROM transactions WHERE (created_date, transaction_id) < {cursor_row} "
+                        "ORDER BY created_date DESC, transaction_id DESC LIMIT ?",
+                        (after, per_page + 1)
+                    )
                 else:
-                    transaction_dict['host_name'] = 'N/A'
-                    transaction_dict['plan_name'] = 'N/A'
-                
-                transactions.append(transaction_dict)
-            
+                    cursor.execute(
+                        "SELECT * FROM transactions ORDER BY created_date DESC, transaction_id DESC LIMIT ?",
+                        (per_page + 1,)
+                    )
+                rows = cursor.fetchall()
+                has_older = len(rows) > per_page
+                rows = rows[:per_page]
+                has_newer = after is not None
+
+            transactions = [dict(row) for row in rows]
+            if transactions:
+                if has_older:
+                    next_cursor = transactions[-1]['transaction_id']
+                if has_newer:
+                    prev_cursor = transactions[0]['transaction_id']
+
     except sqlite3.Error as e:
-        logging.error(f"Failed to get paginated transactions: {e}")
+        logging.error(f"Failed to get transactions page: {e}")
     
-    return transactions, total
+    return transactions, next_cursor, prev_cursor
+
+def record_successful_payment(user_id: int, action: str, key_id: int, host_name: str, client_uuid: str, key_email: str,
+                              expiry_timestamp_ms: int, months: int, price: float, payment_method: str, plan_id: int,
+                              customer_email: str | None, referral_percentage: Decimal) -> dict | None:
+    """Записывает все последствия успешной оплаты одной транзакцией.
+
+    Возвращает key_id, порядковый номер ключа у пользователя и начисленное рефереру вознаграждение,
+    либо None, если запись не удалась и всё было откачено.
+    """
+    try:
+        with transaction():
+            if action == "new":
+                key_id = add_new_key(user_id, host_name, client_uuid, key_email, expiry_timestamp_ms)
+            else:
+                update_key_info(key_id, client_uuid, expiry_timestamp_ms)
+
+            user_data = get_user(user_id) or {}
+            referrer_id = user_data.get('referred_by')
+            reward = Decimal("0")
+            if referrer_id:
+                reward = (Decimal(str(price)) * referral_percentage / 100).quantize(Decimal("0.01"))
+                if reward > 0:
+                    add_to_referral_balance(referrer_id, float(reward))
+
+            update_user_stats(user_id, price, months)
+
+            plan = get_plan_by_id(plan_id)
+            log_transaction(
+                username=user_data.get('username', 'N/A'),
+                transaction_id=None,
+                payment_id=str(uuid.uuid4()),
+                user_id=user_id,
+                status='paid',
+                amount_rub=float(price),
+                amount_currency=None,
+                currency_name=None,
+                payment_method=payment_method or 'Unknown',
+                metadata={
+                    "plan_id": plan_id,
+                    "plan_name": plan.get('plan_name', 'Unknown') if plan else 'Unknown',
+                    "host_name": host_name,
+                    "months": months,
+                    "customer_email": customer_email
+                }
+            )
+
+            user_key_ids = [key['key_id'] for key in get_user_keys(user_id)]
+            key_number = user_key_ids.index(key_id) + 1 if key_id in user_key_ids else len(user_key_ids)
+
+        return {
+            "key_id": key_id,
+            "key_number": key_number,
+            "referrer_id": referrer_id,
+            "referral_reward": reward,
+            "username": user_data.get('username'),
+        }
+    except sqlite3.Error as e:
+        logging.error(f"Failed to record successful payment for user {user_id}: {e}")
+        return None
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
             logging.info(f"Trial period marked as used for user {telegram_id}.")
     except sqlite3.Error as e:
         logging.error(f"Failed to set trial used for user {telegram_id}: {e}")
 
 def add_new_key(user_id: int, host_name: str, xui_client_uuid: str, key_email: str, expiry_timestamp_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(expiry_timestamp_ms / 1000)
             cursor.execute(
-                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date) VALUES (?, ?, ?, ?, ?)",
-                (user_id, host_name, xui_client_uuid, key_email, expiry_date)
+                "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms, notified_marks) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, host_name, xui_client_uuid, key_email, expiry_date, int(expiry_timestamp_ms), _reached_marks(int(expiry_timestamp_ms)))
             )
             new_key_id = cursor.lastrowid
-            conn.commit()
-            return new_key_id
+        _emit_key_changes([(new_key_id, int(expiry_timestamp_ms))])
+        return new_key_id
     except sqlite3.Error as e:
         logging.error(f"Failed to add new key for user {user_id}: {e}")
         return None
 
 def delete_key_by_email(email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (email,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to delete key '{email}': {e}")
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,))
             keys = cursor.fetchall()
@@ -648,8 +1261,7 @@ def get_user_keys(user_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
             key_data = cursor.fetchone()
@@ -660,8 +1272,7 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
             key_data = cursor.fetchone()
@@ -672,11 +1283,14 @@ def get_key_by_email(key_email: str):
 
 def update_key_info(key_id: int, new_xui_uuid: str, new_expiry_ms: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             expiry_date = datetime.fromtimestamp(new_expiry_ms / 1000)
-            cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_id = ?", (new_xui_uuid, expiry_date, key_id))
-            conn.commit()
+            cursor.execute(
+                "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, notified_marks = CASE WHEN ? > COALESCE(expiry_ms, 0) THEN ? ELSE notified_marks END, expiry_ms = ? WHERE key_id = ?",
+                (new_xui_uuid, expiry_date, int(new_expiry_ms), _reached_marks(int(new_expiry_ms)), int(new_expiry_ms), key_id)
+            )
+        _emit_key_changes([(key_id, int(new_expiry_ms))])
     except sqlite3.Error as e:
         logging.error(f"Failed to update key {key_id}: {e}")
 
@@ -686,8 +1300,7 @@ def get_next_key_number(user_id: int) -> int:
 
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE host_name = ?", (host_name,))
             keys = cursor.fetchall()
@@ -696,10 +1309,60 @@ def get_keys_for_host(host_name: str) -> list[dict]:
         logging.error(f"Failed to get keys for host '{host_name}': {e}")
         return []
 
+def host_has_keys_expired_before(host_name: str, before_ms: int) -> bool:
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM vpn_keys WHERE host_name = ? AND expiry_ms < ? LIMIT 1", (host_name, before_ms))
+            return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logging.error(f"Failed to check expired keys for host '{host_name}': {e}")
+        return True
+
+def get_keys_in_expiry_windows(now_ms: int, hours_marks, ahead_ms: int = 3600 * 1000, behind_ms: int = 0) -> list[dict]:
+    """Ключи, чьё напоминание за N часов ещё не отправлено и срок которых попадает в окно
+    [now + N ч - behind_ms, now + N ч + ahead_ms) для каждой отметки N из hours_marks.
+
+    По умолчанию окно — «осталось от N до N+1 часов». Каждая отметка — отдельный диапазон
+    по индексу idx_vpn_keys_expiry_ms; в строке возвращается hours_mark.
+    """
+    marks = sorted(hours_marks)
+    if not marks:
+        return []
+    hour_ms = 3600 * 1000
+    query = " UNION ALL ".join(
+        "SELECT ? AS hours_mark, * FROM vpn_keys WHERE expiry_ms >= ? AND expiry_ms < ? AND (notified_marks & ?) = 0"
+        for _ in marks
+    )
+    params = []
+    for mark in marks:
+        params += [mark, now_ms + mark * hour_ms - behind_ms, now_ms + mark * hour_ms + ahead_ms, NOTIFY_MARK_BITS[mark]]
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get keys in expiry windows: {e}")
+        return []
+
+def mark_keys_notified(notified: list[tuple[int, int]]):
+    """Отмечает отправленные напоминания одним запросом; notified — список (key_id, hours_mark)."""
+    if not notified:
+        return
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE vpn_keys SET notified_marks = notified_marks | ? WHERE key_id = ?",
+                [(NOTIFY_MARK_BITS[hours_mark], key_id) for key_id, hours_mark in notified]
+            )
+    except sqlite3.Error as e:
+        logging.error(f"Failed to mark {len(notified)} keys as notified: {e}")
+
 def get_all_vpn_users():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
             users = cursor.fetchall()
@@ -710,21 +1373,54 @@ def get_all_vpn_users():
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = datetime.fromtimestamp(xui_client_data.expiry_time / 1000)
-                cursor.execute("UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?", (xui_client_data.id, expiry_date, key_email))
+                cursor.execute(
+                    "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, notified_marks = CASE WHEN ? > COALESCE(expiry_ms, 0) THEN ? ELSE notified_marks END, expiry_ms = ? WHERE key_email = ?",
+                    (xui_client_data.id, expiry_date, xui_client_data.expiry_time, _reached_marks(xui_client_data.expiry_time), xui_client_data.expiry_time, key_email)
+                )
             else:
                 cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
-            conn.commit()
+        if xui_client_data:
+            _emit_key_changes(None)
     except sqlite3.Error as e:
         logging.error(f"Failed to update key status for {key_email}: {e}")
 
+def apply_sync_changes(host_name: str, updates: list[tuple[str, str, int]], deletes: list[str]) -> int | None:
+    """Применяет результат синхронизации хоста одной транзакцией.
+
+    updates — список (key_email, xui_client_uuid, expiry_timestamp_ms), deletes — список key_email.
+    Возвращает количество затронутых записей или None, если запись в базу не удалась.
+    """
+    if not updates and not deletes:
+        return 0
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ?, notified_marks = CASE WHEN ? > COALESCE(expiry_ms, 0) THEN ? ELSE notified_marks END, expiry_ms = ? "
+                "WHERE key_email = ? AND host_name = ?",
+                [(client_uuid, datetime.fromtimestamp(expiry_ms / 1000), expiry_ms, _reached_marks(expiry_ms), expiry_ms, key_email, host_name) for key_email, client_uuid, expiry_ms in updates]
+            )
+            updated = cursor.rowcount
+            cursor.executemany(
+                "DELETE FROM vpn_keys WHERE key_email = ? AND host_name = ?",
+                [(key_email, host_name) for key_email in deletes]
+            )
+            deleted = cursor.rowcount
+        if updated:
+            _emit_key_changes(None)
+        return updated + deleted
+    except sqlite3.Error as e:
+        logging.error(f"Failed to apply sync changes for host '{host_name}': {e}")
+        return None
+
 def get_daily_stats_for_charts(days: int = 30) -> dict:
     stats = {'users': {}, 'keys': {}}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             query_users = """
                 SELECT date(registration_date) as day, COUNT(*)
@@ -755,8 +1451,7 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             query = """
                 SELECT
@@ -778,16 +1473,15 @@ def get_recent_transactions(limit: int = 15) -> list[dict]:
 
 def add_support_thread(user_id: int, thread_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)", (user_id, thread_id))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to add support thread for user {user_id}: {e}")
 
 def get_support_thread_id(user_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT thread_id FROM support_threads WHERE user_id = ?", (user_id,))
             result = cursor.fetchone()
@@ -798,7 +1492,7 @@ def get_support_thread_id(user_id: int) -> int | None:
 
 def get_user_id_by_thread(thread_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT user_id FROM support_threads WHERE thread_id = ?", (thread_id,))
             result = cursor.fetchone()
@@ -809,8 +1503,7 @@ def get_user_id_by_thread(thread_id: int) -> int | None:
 
 def get_latest_transaction(user_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY created_date DESC LIMIT 1", (user_id,))
             transaction = cursor.fetchone()
@@ -821,8 +1514,7 @@ def get_latest_transaction(user_id: int) -> dict | None:
 
 def get_all_users() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
             return [dict(row) for row in cursor.fetchall()]
@@ -832,41 +1524,37 @@ def get_all_users() -> list[dict]:
 
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to ban user {telegram_id}: {e}")
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to unban user {telegram_id}: {e}")
 
 def delete_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to delete keys for user {user_id}: {e}")
 
 def create_bank_payment_document(transaction_id: int, user_id: int, file_id: str, file_type: str) -> int:
     """Создает запись о документе оплаты"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO bank_payment_documents (transaction_id, user_id, file_id, file_type, status) VALUES (?, ?, ?, ?, 'pending')",
                 (transaction_id, user_id, file_id, file_type)
             )
-            conn.commit()
             return cursor.lastrowid
     except sqlite3.Error as e:
         logging.error(f"Failed to create bank payment document: {e}")
@@ -875,11 +1563,10 @@ def create_bank_payment_document(transaction_id: int, user_id: int, file_id: str
 def get_pending_bank_payment_documents() -> list[dict]:
     """Получает все документы, ожидающие проверки"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT bpd.*, t.amount_rub, t.metadata, u.username
+                SELECT bpd.*, t.amount_rub, t.host_name, t.plan_name, u.username
                 FROM bank_payment_documents bpd
                 JOIN transactions t ON bpd.transaction_id = t.transaction_id
                 LEFT JOIN users u ON bpd.user_id = u.telegram_id
@@ -894,8 +1581,7 @@ def get_pending_bank_payment_documents() -> list[dict]:
 def get_bank_payment_document(document_id: int) -> dict | None:
     """Получает документ по ID"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM bank_payment_documents WHERE document_id = ?", (document_id,))
             row = cursor.fetchone()
@@ -907,21 +1593,19 @@ def get_bank_payment_document(document_id: int) -> dict | None:
 def update_bank_payment_document_status(document_id: int, status: str, reviewed_by: int = None):
     """Обновляет статус документа (approved/rejected)"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE bank_payment_documents SET status = ?, reviewed_date = CURRENT_TIMESTAMP, reviewed_by = ? WHERE document_id = ?",
                 (status, reviewed_by, document_id)
             )
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update bank payment document status: {e}")
 
 def get_transaction_by_id(transaction_id: int) -> dict | None:
     """Получает транзакцию по ID"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM transactions WHERE transaction_id = ?", (transaction_id,))
             row = cursor.fetchone()
@@ -933,7 +1617,7 @@ def get_transaction_by_id(transaction_id: int) -> dict | None:
 def update_transaction_status(transaction_id: int, status: str, payment_method: str = None):
     """Обновляет статус транзакции"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             if payment_method:
                 cursor.execute(
@@ -945,6 +1629,5 @@ def update_transaction_status(transaction_id: int, status: str, payment_method:
                     "UPDATE transactions SET status = ? WHERE transaction_id = ?",
                     (status, transaction_id)
                 )
-            conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update transaction status: {e}")
@@ -1,19 +1,35 @@
 import asyncio
+import hashlib
+import heapq
 import logging
+import time
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram import Bot
 
 from shop_bot.bot_controller import BotController
 from shop_bot.data_manager import database
-from shop_bot.modules import xui_api
+from shop_bot.modules import xui_api, host_health
 from shop_bot.bot import keyboards
 
 CHECK_INTERVAL_SECONDS = 300
-NOTIFY_BEFORE_HOURS = {72, 48, 24, 1}
-notified_users = {}
+SYNC_MAX_CONCURRENT_HOSTS = 5
+SYNC_HOST_TIMEOUT_SECONDS = 120
+WAL_CHECKPOINT_INTERVAL_SECONDS = 600
+STATS_REBUILD_INTERVAL_SECONDS = 3600
+NOTIFY_BEFORE_HOURS = set(database.NOTIFY_MARK_BITS)
+EXPIRED_KEY_GRACE_DAYS = 5
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+NOTIFY_GRACE_MS = HOUR_MS
+NOTIFIER_HORIZON_SECONDS = 6 * 3600
+NOTIFIER_BOT_RETRY_SECONDS = 60
+
+# Отпечатки списков клиентов по хостам с последней успешной синхронизации и статистика изменений.
+host_fingerprints = {}
+host_sync_stats = {}
 
 logger = logging.getLogger(__name__)
 
@@ -57,134 +73,304 @@ async def send_subscription_notification(bot: Bot, user_id: int, key_id: int, ti
     except Exception as e:
         logger.error(f"Error sending subscription notification to user {user_id}: {e}")
 
-def _cleanup_notified_users(all_db_keys: list[dict]):
-    if not notified_users:
-        return
+class ExpiryNotifier:
+    """Отправляет напоминания об окончании ключей точно в момент каждой отметки NOTIFY_BEFORE_HOURS.
 
-    logger.info("Scheduler: Cleaning up the notification cache...")
-    
-    active_key_ids = {key['key_id'] for key in all_db_keys}
-    
-    users_to_check = list(notified_users.keys())
-    
-    cleaned_users = 0
-    cleaned_keys = 0
-
-    for user_id in users_to_check:
-        keys_to_check = list(notified_users[user_id].keys())
-        for key_id in keys_to_check:
-            if key_id not in active_key_ids:
-                del notified_users[user_id][key_id]
-                cleaned_keys += 1
-        
-        if not notified_users[user_id]:
-            del notified_users[user_id]
-            cleaned_users += 1
-    
-    if cleaned_users > 0 or cleaned_keys > 0:
-        logger.info(f"Scheduler: Cleanup complete. Removed {cleaned_users} user entries and {cleaned_keys} key entries from the cache.")
+    В куче хранятся только срабатывания ближайших NOTIFIER_HORIZON_SECONDS; по истечении горизонта
+    они перечитываются из базы. Изменения ключей приходят от database через add_key_listener из любого
+    потока и переносятся в цикл событий через call_soon_threadsafe. Перед отправкой ключ перечитывается
+    из базы, поэтому устаревшие записи в куче просто отбрасываются. Пока бот остановлен, наступившие
+    напоминания откладываются и повторяются раз в NOTIFIER_BOT_RETRY_SECONDS.
+    """
 
-async def check_expiring_subscriptions(bot: Bot):
-    logger.info("Scheduler: Checking for expiring subscriptions...")
-    current_time = datetime.now()
-    all_keys = database.get_all_keys()
-    
-    _cleanup_notified_users(all_keys)
-    
-    for key in all_keys:
-        try:
-            expiry_date = datetime.fromisoformat(key['expiry_date'])
-            time_left = expiry_date - current_time
-
-            if time_left.total_seconds() < 0:
-                continue
-
-            total_hours_left = int(time_left.total_seconds() / 3600)
-            user_id = key['user_id']
-            key_id = key['key_id']
-
-            for hours_mark in NOTIFY_BEFORE_HOURS:
-                if hours_mark - 1 < total_hours_left <= hours_mark:
-                    notified_users.setdefault(user_id, {}).setdefault(key_id, set())
-                    
-                    if hours_mark not in notified_users[user_id][key_id]:
-                        await send_subscription_notification(bot, user_id, key_id, hours_mark, expiry_date)
-                        notified_users[user_id][key_id].add(hours_mark)
-                    break 
-                    
-        except Exception as e:
-            logger.error(f"Error processing expiry for key {key.get('key_id')}: {e}")
+    def __init__(self, bot_controller: BotController):
+        self._bot_controller = bot_controller
+        self._heap = []
+        self._scheduled = set()
+        self._deferred = set()
+        self._retry_at_ms = 0
+        self._horizon_end_ms = 0
+        self._reload_requested = True
+        # Изменения, пришедшие во время перечитывания из базы; None, когда перечитывания нет.
+        self._changes_during_reload = None
+        self._loop = None
+        self._wakeup = asyncio.Event()
 
-async def sync_keys_with_panels():
-    logger.info("Scheduler: Starting sync with XUI panels...")
-    total_affected_records = 0
-    
-    all_hosts = database.get_all_hosts()
-    if not all_hosts:
-        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
-        return
+    def on_key_changes(self, changes: list[tuple[int, int]] | None):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._apply_changes, changes)
 
-    for host in all_hosts:
-        host_name = host['host_name']
-        logger.info(f"Scheduler: Processing host: '{host_name}'")
-        
+    def _apply_changes(self, changes: list[tuple[int, int]] | None):
+        if changes is None:
+            self._reload_requested = True
+        elif self._changes_during_reload is not None:
+            # Куча будет заменена результатом запроса, который мог прочитать базу до этой записи.
+            self._changes_during_reload.extend(changes)
+        else:
+            now_ms = int(time.time() * 1000)
+            # Новый или продлённый срок: отметки, время которых уже прошло, не отправляем.
+            for key_id, expiry_ms in changes:
+                for hours_mark in NOTIFY_BEFORE_HOURS:
+                    self._push(key_id, hours_mark, expiry_ms, now_ms, grace_ms=0)
+        self._wakeup.set()
+
+    def _push(self, key_id: int, hours_mark: int, expiry_ms: int, now_ms: int, grace_ms: int = NOTIFY_GRACE_MS):
+        fire_at_ms = expiry_ms - hours_mark * HOUR_MS
+        # Пропущенную отметку (например, во время простоя) ещё отправляем в течение grace_ms.
+        if not (now_ms - grace_ms < fire_at_ms < self._horizon_end_ms):
+            return
+        entry = (fire_at_ms, key_id, hours_mark, expiry_ms)
+        if entry not in self._scheduled:
+            self._scheduled.add(entry)
+            heapq.heappush(self._heap, entry)
+
+    async def _reload(self):
+        now_ms = int(time.time() * 1000)
+        self._reload_requested = False
+        self._horizon_end_ms = now_ms + NOTIFIER_HORIZON_SECONDS * 1000
+        self._changes_during_reload = []
         try:
-            api, inbound = xui_api.login_to_host(
-                host_url=host['host_url'],
-                username=host['host_username'],
-                password=host['host_pass'],
-                inbound_id=host['host_inbound_id']
+            keys = await database.aio.get_keys_in_expiry_windows(
+                now_ms, NOTIFY_BEFORE_HOURS, ahead_ms=NOTIFIER_HORIZON_SECONDS * 1000, behind_ms=NOTIFY_GRACE_MS
             )
+        except BaseException:
+            # Следующее перечитывание увидит в базе и отложенные изменения.
+            self._reload_requested = True
+            raise
+        finally:
+            changes, self._changes_during_reload = self._changes_during_reload, None
+        self._heap = []
+        self._scheduled = set()
+        for key in keys:
+            self._push(key['key_id'], key['hours_mark'], key['expiry_ms'], now_ms)
+        if changes:
+            self._apply_changes(changes)
+        logger.info(f"Scheduler: Expiry notifier loaded {len(self._heap)} pending notifications for the next {NOTIFIER_HORIZON_SECONDS // 3600} hours.")
 
-            if not api or not inbound:
-                logger.error(f"Scheduler: Could not log in to host '{host_name}'. Skipping this host.")
-                continue
-            
-            full_inbound_details = api.inbound.get_by_id(inbound.id)
-            clients_on_server = {client.email: client for client in (full_inbound_details.settings.clients or [])}
-            logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
+    async def _fire(self, due: list[tuple[int, int, int, int]]):
+        bot = self._bot_controller.get_bot_instance() if self._bot_controller.get_status().get("is_running") else None
+        if not bot:
+            logger.info(f"Scheduler: Bot is stopped, postponing {len(due)} expiry notifications.")
+            self._deferred.update(due)
+            self._retry_at_ms = int(time.time() * 1000) + NOTIFIER_BOT_RETRY_SECONDS * 1000
+            return
 
-            keys_in_db = database.get_keys_for_host(host_name)
-            
-            for db_key in keys_in_db:
-                key_email = db_key['key_email']
-                expiry_date = datetime.fromisoformat(db_key['expiry_date'])
-                now = datetime.now()
-                if expiry_date < now - timedelta(days=5):
-                    logger.info(f"Scheduler: Key '{key_email}' expired more than 5 days ago. Deleting from panel and DB.")
+        notified = []
+        sent_keys = set()
+        now_ms = int(time.time() * 1000)
+        try:
+            # Отложенные напоминания могут накопиться у одного ключа: отправляем только ближайшее
+            # к окончанию, остальные отметки просто помечаем отправленными.
+            for fire_at_ms, key_id, hours_mark, expiry_ms in sorted(due, key=lambda entry: entry[2]):
+                try:
+                    key = await database.aio.get_key_by_id(key_id)
+                    if not key or key['expiry_ms'] != expiry_ms or key['notified_marks'] & database.NOTIFY_MARK_BITS[hours_mark]:
+                        continue
+                    if key_id in sent_keys or expiry_ms <= now_ms:
+                        notified.append((key_id, hours_mark))
+                        continue
+                    expiry_date = datetime.fromtimestamp(expiry_ms / 1000)
+                    await send_subscription_notification(bot, key['user_id'], key_id, hours_mark, expiry_date)
+                    notified.append((key_id, hours_mark))
+                    sent_keys.add(key_id)
+                except Exception as e:
+                    logger.error(f"Error processing expiry for key {key_id}: {e}")
+        finally:
+            await database.aio.mark_keys_notified(notified)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        database.add_key_listener(self.on_key_changes)
+        try:
+            while True:
+                self._wakeup.clear()
+                now_ms = int(time.time() * 1000)
+                if self._reload_requested or now_ms >= self._horizon_end_ms:
+                    await self._reload()
+                    now_ms = int(time.time() * 1000)
+
+                due = []
+                while self._heap and self._heap[0][0] <= now_ms:
+                    entry = heapq.heappop(self._heap)
+                    self._scheduled.discard(entry)
+                    due.append(entry)
+                if self._deferred and now_ms >= self._retry_at_ms:
+                    due.extend(self._deferred)
+                    self._deferred.clear()
+                if due:
                     try:
-                        await xui_api.delete_client_on_host(host_name, key_email)
+                        await self._fire(due)
                     except Exception as e:
-                        logger.error(f"Scheduler: Failed to delete client '{key_email}' from panel: {e}")
-                    database.delete_key_by_email(key_email)
-                    total_affected_records += 1
+                        logger.error(f"Scheduler: Expiry notifier failed to send notifications: {e}", exc_info=True)
                     continue
 
-                server_client = clients_on_server.pop(key_email, None)
+                next_at_ms = min(self._heap[0][0], self._horizon_end_ms) if self._heap else self._horizon_end_ms
+                if self._deferred:
+                    next_at_ms = min(next_at_ms, self._retry_at_ms)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(0, next_at_ms - now_ms) / 1000)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            database.remove_key_listener(self.on_key_changes)
 
-                if server_client:
-                    reset_days = server_client.reset if server_client.reset is not None else 0
-                    server_expiry_ms = server_client.expiry_time + reset_days * 24 * 3600 * 1000
-                    local_expiry_dt = expiry_date
-                    local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
+async def run_expiry_notifier(bot_controller: BotController):
+    logger.info("Scheduler: Expiry notifier has been started.")
+    await ExpiryNotifier(bot_controller).run()
 
-                    if abs(server_expiry_ms - local_expiry_ms) > 1000:
-                        database.update_key_status_from_server(key_email, server_client)
-                        total_affected_records += 1
-                        logger.info(f"Scheduler: Synced (updated) key '{key_email}' for host '{host_name}'.")
-                else:
-                    logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
-                    database.update_key_status_from_server(key_email, None)
-                    total_affected_records += 1
+def _clients_fingerprint(clients: list) -> str:
+    """Хэш списка клиентов инбаунда по полям, которые влияют на синхронизацию."""
+    digest = hashlib.blake2b(digest_size=16)
+    for email, expiry_time, reset, enable in sorted(
+        (client.email, client.expiry_time, client.reset, client.enable) for client in clients
+    ):
+        digest.update(f"{email}|{expiry_time}|{reset}|{enable}\n".encode())
+    return digest.hexdigest()
 
-            if clients_on_server:
-                for orphan_email in clients_on_server.keys():
-                    logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on host '{host_name}' that is not tracked by the bot.")
+async def _purge_expired_clients(host_name: str, clients_on_server: dict, expired_emails: list[str]) -> list[str]:
+    """Удаляет с панели клиентов, истёкших более EXPIRED_KEY_GRACE_DAYS дней назад, через очередь записи хоста.
 
+    Возвращает email тех, кого на панели больше нет; только они удаляются из базы, остальные
+    будут повторены в следующем цикле. Удаления идут по одному клиенту и упорядочены с покупками,
+    поэтому клиенты, добавленные во время синхронизации, не теряются.
+    """
+    purged = []
+    pending = []
+    for key_email in expired_emails:
+        server_client = clients_on_server.get(key_email)
+        if server_client is None:
+            purged.append(key_email)
+            continue
+        pending.append((key_email, xui_api.enqueue_client_delete(host_name, server_client.id)))
+    for key_email, future in pending:
+        try:
+            await future
+            purged.append(key_email)
         except Exception as e:
-            logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}", exc_info=True)
+            logger.error(f"Scheduler: Failed to delete expired client '{key_email}' from host '{host_name}': {e}")
+    logger.info(f"Scheduler: Purged {len(purged)}/{len(expired_emails)} keys on host '{host_name}' "
+                f"that expired more than {EXPIRED_KEY_GRACE_DAYS} days ago.")
+    return purged
+
+async def _sync_host(host: dict) -> int:
+    host_name = host['host_name']
+    logger.info(f"Scheduler: Processing host: '{host_name}'")
+
+    xui, inbound = await xui_api.get_session(host)
+
+    if not xui or not inbound:
+        logger.error(f"Scheduler: Could not log in to host '{host_name}'. Skipping this host.")
+        return 0
+    
+    try:
+        full_inbound_details = await xui.get_inbound(inbound.id)
+    except Exception:
+        xui_api.invalidate_session(host_name)
+        raise
+    if full_inbound_details:
+        xui_api.update_session_inbound(host_name, full_inbound_details)
+    params = xui_api.host_link_params(host, full_inbound_details)
+    if params:
+        await database.aio.update_host_reality_params(host_name, params)
+    server_clients = full_inbound_details.clients
+    clients_on_server = {client.email: client for client in server_clients}
+    logger.info(f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel.")
+
+    stats = host_sync_stats.setdefault(host_name, {"cycles": 0, "skipped": 0, "changed_records": 0})
+    stats["cycles"] += 1
+    fingerprint = _clients_fingerprint(server_clients)
+    purge_before_ms = int(time.time() * 1000) - EXPIRED_KEY_GRACE_DAYS * DAY_MS
+
+    if host_fingerprints.get(host_name) == fingerprint and not await database.aio.host_has_keys_expired_before(host_name, purge_before_ms):
+        stats["skipped"] += 1
+        logger.info(f"Scheduler: Host '{host_name}' unchanged since last sync, skipped "
+                    f"({stats['skipped']}/{stats['cycles']} cycles skipped).")
+        return 0
+
+    keys_in_db = await database.aio.get_keys_for_host(host_name)
+    updates = []
+    deletes = []
+    expired_emails = []
+    
+    for db_key in keys_in_db:
+        key_email = db_key['key_email']
+        local_expiry_ms = db_key['expiry_ms']
+        if local_expiry_ms < purge_before_ms:
+            expired_emails.append(key_email)
+            continue
+
+        server_client = clients_on_server.pop(key_email, None)
+
+        if server_client:
+            reset_days = server_client.reset if server_client.reset is not None else 0
+            server_expiry_ms = server_client.expiry_time + reset_days * DAY_MS
+
+            if abs(server_expiry_ms - local_expiry_ms) > 1000:
+                updates.append((key_email, server_client.id, server_expiry_ms))
+                logger.info(f"Scheduler: Synced (updated) key '{key_email}' for host '{host_name}'.")
+        else:
+            logger.warning(f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Deleting from local DB.")
+            deletes.append(key_email)
+
+    if expired_emails:
+        purged_emails = await _purge_expired_clients(host_name, clients_on_server, expired_emails)
+        deletes.extend(purged_emails)
+        purged = set(purged_emails)
+        fingerprint = _clients_fingerprint([client for client in server_clients if client.email not in purged])
+        for key_email in expired_emails:
+            clients_on_server.pop(key_email, None)
+
+    affected = await database.aio.apply_sync_changes(host_name, updates, deletes)
+    if affected is None:
+        # Изменения не записаны: без отпечатка следующий цикл сверит хост заново.
+        host_fingerprints.pop(host_name, None)
+        logger.error(f"Scheduler: Sync changes for host '{host_name}' were not saved, will retry next cycle.")
+        return 0
+    host_fingerprints[host_name] = fingerprint
+    stats["changed_records"] += affected
+    change_rate = affected / len(keys_in_db) * 100 if keys_in_db else 0
+    logger.info(f"Scheduler: Host '{host_name}': {affected}/{len(keys_in_db)} keys changed ({change_rate:.1f}%), "
+                f"{stats['changed_records']} changes over {stats['cycles']} cycles.")
+
+    if clients_on_server:
+        for orphan_email in clients_on_server.keys():
+            logger.warning(f"Scheduler: Found orphan client '{orphan_email}' on host '{host_name}' that is not tracked by the bot.")
+
+    return affected
+
+async def _sync_host_limited(host: dict, semaphore: asyncio.Semaphore) -> int:
+    host_name = host['host_name']
+    if host_health.is_down(host_name):
+        logger.warning(f"Scheduler: Host '{host_name}' is marked as down, sync skipped until the next probe.")
+        return 0
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            affected = await asyncio.wait_for(_sync_host(host), timeout=SYNC_HOST_TIMEOUT_SECONDS)
+            logger.info(f"Scheduler: Host '{host_name}' synced in {time.perf_counter() - started:.2f}s, {affected} records affected.")
+            return affected
+        except asyncio.TimeoutError:
+            logger.error(f"Scheduler: Sync of host '{host_name}' timed out after {SYNC_HOST_TIMEOUT_SECONDS}s.")
+        except Exception as e:
+            logger.error(f"Scheduler: An unexpected error occurred while processing host '{host_name}' "
+                         f"after {time.perf_counter() - started:.2f}s: {e}", exc_info=True)
+        return 0
+
+async def sync_keys_with_panels():
+    logger.info("Scheduler: Starting sync with XUI panels...")
+    started = time.perf_counter()
+    
+    all_hosts = await database.aio.get_all_hosts()
+    if not all_hosts:
+        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
+        return
+
+    semaphore = asyncio.Semaphore(SYNC_MAX_CONCURRENT_HOSTS)
+    results = await asyncio.gather(*(_sync_host_limited(host, semaphore) for host in all_hosts))
+    total_affected_records = sum(results)
             
-    logger.info(f"Scheduler: Sync with XUI panels finished. Total records affected: {total_affected_records}.")
+    logger.info(f"Scheduler: Sync with XUI panels finished in {time.perf_counter() - started:.2f}s "
+                f"for {len(all_hosts)} hosts. Total records affected: {total_affected_records}.")
 
 async def periodic_subscription_check(bot_controller: BotController):
     logger.info("Scheduler has been started.")
@@ -194,17 +380,21 @@ async def periodic_subscription_check(bot_controller: BotController):
         try:
             await sync_keys_with_panels()
 
-            if bot_controller.get_status().get("is_running"):
-                bot = bot_controller.get_bot_instance()
-                if bot:
-                    await check_expiring_subscriptions(bot)
-                else:
-                    logger.warning("Scheduler: Bot is marked as running, but instance is not available.")
-            else:
-                logger.info("Scheduler: Bot is stopped, skipping user notifications.")
-
         except Exception as e:
             logger.error(f"Scheduler: An unhandled error occurred in the main loop: {e}", exc_info=True)
             
         logger.info(f"Scheduler: Cycle finished. Next check in {CHECK_INTERVAL_SECONDS} seconds.")
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
\ No newline at end of file
+        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+
+async def periodic_wal_checkpoint():
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL_SECONDS)
+        result = await database.aio.checkpoint_wal()
+        if result:
+            busy, log_frames, checkpointed = result
+            logger.info(f"Scheduler: WAL checkpoint done (busy={busy}, wal_frames={log_frames}, checkpointed={checkpointed}).")
+
+async def periodic_stats_rebuild():
+    while True:
+        await asyncio.sleep(STATS_REBUILD_INTERVAL_SECONDS)
+        await database.aio.rebuild_stats()
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Вес нового замера в скользящих средних задержки и доли ошибок.
+HEALTH_EWMA_ALPHA = 0.2
+# Столько ошибок подряд открывают автомат: запросы к хосту сразу отклоняются.
+BREAKER_FAILURE_THRESHOLD = 3
+# Через сколько секунд открытый автомат пропускает одну пробную попытку; при новых неудачах пауза удваивается.
+BREAKER_OPEN_SECONDS = 30
+BREAKER_MAX_OPEN_SECONDS = 600
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+class HostUnavailableError(ConnectionError):
+    """Автомат хоста открыт: панель недавно не отвечала, запрос отклонён без обращения к ней."""
+
+class HostHealth:
+    """Состояние одного хоста: EWMA задержки и доли ошибок и автомат closed/open/half_open."""
+
+    def __init__(self, host_name: str):
+        self.host_name = host_name
+        self.state = STATE_CLOSED
+        self.latency_ms: float | None = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.opened_at = 0.0
+        self.last_error: str | None = None
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+
+    def _retry_at(self) -> float:
+        return self.opened_at + self.open_seconds
+
+    def allow_request(self) -> bool:
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and time.monotonic() >= self._retry_at():
+            self.state = STATE_HALF_OPEN
+            self._probe_in_flight = False
+        # Пробная попытка, от которой так и не пришёл результат, не должна заблокировать хост навсегда.
+        if self.state == STATE_HALF_OPEN and (not self._probe_in_flight or time.monotonic() - self._probe_started > BREAKER_OPEN_SECONDS):
+            self._probe_in_flight = True
+            self._probe_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self, latency_ms: float):
+        self.latency_ms = latency_ms if self.latency_ms is None else (1 - HEALTH_EWMA_ALPHA) * self.latency_ms + HEALTH_EWMA_ALPHA * latency_ms
+        self.error_rate *= 1 - HEALTH_EWMA_ALPHA
+        self.consecutive_failures = 0
+        if self.state != STATE_CLOSED:
+            logger.info(f"Host '{self.host_name}' is reachable again, circuit closed.")
+        self.state = STATE_CLOSED
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self._probe_in_flight = False
+
+    def record_failure(self, error: Exception):
+        self.error_rate = (1 - HEALTH_EWMA_ALPHA) * self.error_rate + HEALTH_EWMA_ALPHA
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}" if str(error) else type(error).__name__
+        self._probe_in_flight = False
+        if self.state == STATE_HALF_OPEN:
+            self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+            self._open()
+        elif self.state == STATE_CLOSED and self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+            self._open()
+
+    def _open(self):
+        self.state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        logger.warning(f"Host '{self.host_name}' circuit opened after {self.consecutive_failures} failures "
+                       f"({self.last_error}); next probe in {self.open_seconds}s.")
+
+    def is_down(self) -> bool:
+        return self.state == STATE_OPEN and time.monotonic() < self._retry_at()
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "is_down": self.is_down(),
+            "latency_ms": round(self.latency_ms) if self.latency_ms is not None else None,
+            "error_rate": round(self.error_rate * 100),
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": max(0, round(self._retry_at() - time.monotonic())) if self.state == STATE_OPEN else None,
+            "last_error": self.last_error
+        }
+
+# Состояние читается и потоком Flask (страница настроек), поэтому доступ идёт под блокировкой.
+_hosts: dict[str, HostHealth] = {}
+_lock = threading.Lock()
+
+def _get(host_name: str) -> HostHealth:
+    health = _hosts.get(host_name)
+    if health is None:
+        health = _hosts[host_name] = HostHealth(host_name)
+    return health
+
+def allow_request(host_name: str) -> bool:
+    with _lock:
+        return _get(host_name).allow_request()
+
+def check(host_name: str):
+    """Бросает HostUnavailableError, если автомат хоста не пропускает запрос."""
+    if not allow_request(host_name):
+        raise HostUnavailableError(f"Host '{host_name}' is temporarily unavailable")
+
+def record_success(host_name: str, latency_ms: float):
+    with _lock:
+        _get(host_name).record_success(latency_ms)
+
+def record_failure(host_name: str, error: Exception):
+    with _lock:
+        _get(host_name).record_failure(error)
+
+def is_down(host_name: str) -> bool:
+    with _lock:
+        health = _hosts.get(host_name)
+        return health.is_down() if health else False
+
+def forget(host_name: str):
+    with _lock:
+        _hosts.pop(host_name, None)
+
+def snapshot() -> dict[str, dict]:
+    with _lock:
+        return {host_name: health.to_dict() for host_name, health in _hosts.items()}
@@ -1,126 +1,400 @@
+import asyncio
 import uuid
 from datetime import datetime, timedelta
 import logging
+import threading
+import time
+from collections import deque
+from itertools import groupby
 from urllib.parse import urlparse
-from typing import List, Dict
+from typing import Dict
 
-from py3xui import Api, Client, Inbound
-
-from shop_bot.data_manager.database import get_host, get_key_by_email
+from shop_bot.modules import host_health
+from shop_bot.modules.xui_client import XUIClient, Client, Inbound
+from shop_bot.data_manager.database import aio, add_host_listener
 
 logger = logging.getLogger(__name__)
 
-def login_to_host(host_url: str, username: str, password: str, inbound_id: int) -> tuple[Api | None, Inbound | None]:
+# Закэшированный инбаунд перечитывается с панели не реже, чем раз в SESSION_MAX_AGE_SECONDS.
+SESSION_MAX_AGE_SECONDS = 3600
+
+_sessions = {}
+# Клиенты удалённых или изменённых хостов; закрываются в цикле событий при следующем обращении.
+_stale_clients = []
+_sessions_lock = threading.Lock()
+# Вход и перечитывание инбаунда хоста выполняются под его блокировкой, чтобы одновременные промахи
+# кэша не открывали несколько сессий, из которых в _sessions попадёт только одна.
+_session_locks: dict[str, asyncio.Lock] = {}
+
+# Сколько изменений очередь хоста забирает за один проход (и сколько клиентов максимум уходит одним addClient).
+WRITE_BATCH_MAX = 100
+# С какого числа email в пачке выгоднее один раз прочитать инбаунд, чем искать каждого клиента отдельно.
+WRITE_LOOKUP_INBOUND_MIN = 20
+
+async def login_to_host(host_url: str, username: str, password: str, inbound_id: int, host_name: str | None = None) -> tuple[XUIClient | None, Inbound | None]:
+    client = XUIClient(host_url, username, password, host_name=host_name)
     try:
-        api = Api(host=host_url, username=username, password=password)
-        api.login()
-        inbounds: List[Inbound] = api.inbound.get_list()
-        target_inbound = next((inbound for inbound in inbounds if inbound.id == inbound_id), None)
+        await client.login()
+        target_inbound = await client.get_inbound(inbound_id)
         
         if target_inbound is None:
             logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
-            return api, None
-        return api, target_inbound
+            await client.close()
+            return None, None
+        return client, target_inbound
     except Exception as e:
         logger.error(f"Login or inbound retrieval failed for host '{host_url}': {e}", exc_info=True)
+        await client.close()
+        return None, None
+
+def _session_fingerprint(host_data: dict) -> tuple:
+    return (host_data['host_url'], host_data['host_username'], host_data['host_pass'], host_data['host_inbound_id'])
+
+async def _close_stale_clients():
+    with _sessions_lock:
+        stale = _stale_clients[:]
+        _stale_clients.clear()
+    for client in stale:
+        await client.close()
+
+async def get_session(host_data: dict) -> tuple[XUIClient | None, Inbound | None]:
+    """Возвращает клиент панели и целевой инбаунд хоста, переиспользуя их между вызовами.
+
+    Новый вход выполняется, если сессии нет или изменились параметры подключения хоста;
+    устаревший (старше SESSION_MAX_AGE_SECONDS) инбаунд перечитывается в той же сессии.
+    """
+    await _close_stale_clients()
+    host_name = host_data['host_name']
+    if host_health.is_down(host_name):
+        logger.warning(f"Host '{host_name}' is marked as down, skipping panel request.")
         return None, None
+    fingerprint = _session_fingerprint(host_data)
+    session = await _cached_session(host_name, fingerprint)
+    if session and time.monotonic() - session['created'] < SESSION_MAX_AGE_SECONDS:
+        return session['client'], session['inbound']
+
+    async with _session_locks.setdefault(host_name, asyncio.Lock()):
+        # Пока ждали блокировку, сессию мог открыть или обновить другой вызов.
+        session = await _cached_session(host_name, fingerprint)
+        if session and time.monotonic() - session['created'] < SESSION_MAX_AGE_SECONDS:
+            return session['client'], session['inbound']
+        return await _open_session(host_data, session, fingerprint)
+
+async def _cached_session(host_name: str, fingerprint: tuple) -> dict | None:
+    with _sessions_lock:
+        session = _sessions.get(host_name)
+    if session and session['fingerprint'] != fingerprint:
+        invalidate_session(host_name)
+        await _close_stale_clients()
+        return None
+    return session
+
+async def _open_session(host_data: dict, session: dict | None, fingerprint: tuple) -> tuple[XUIClient | None, Inbound | None]:
+    host_name = host_data['host_name']
+    if session:
+        client = session['client']
+        try:
+            inbound = await client.get_inbound(host_data['host_inbound_id'])
+        except Exception as e:
+            logger.error(f"Inbound refresh failed for host '{host_name}': {e}")
+            inbound = None
+        if inbound is None:
+            invalidate_session(host_name)
+            await _close_stale_clients()
+            return None, None
+    else:
+        client, inbound = await login_to_host(
+            host_url=host_data['host_url'],
+            username=host_data['host_username'],
+            password=host_data['host_pass'],
+            inbound_id=host_data['host_inbound_id'],
+            host_name=host_name
+        )
+        if not client:
+            return None, None
+
+    with _sessions_lock:
+        _sessions[host_name] = {"client": client, "inbound": inbound, "fingerprint": fingerprint, "created": time.monotonic()}
+    return client, inbound
+
+def update_session_inbound(host_name: str, inbound: Inbound):
+    """Заменяет закэшированный инбаунд хоста только что прочитанным с панели."""
+    with _sessions_lock:
+        session = _sessions.get(host_name)
+        if session and session['inbound'].id == inbound.id:
+            session['inbound'] = inbound
+            session['created'] = time.monotonic()
+
+def invalidate_session(host_name: str):
+    # Может вызываться из потока Flask, поэтому сессия только откладывается на закрытие.
+    with _sessions_lock:
+        session = _sessions.pop(host_name, None)
+        if session:
+            _stale_clients.append(session['client'])
+
+async def close_sessions():
+    with _sessions_lock:
+        _stale_clients.extend(session['client'] for session in _sessions.values())
+        _sessions.clear()
+    await _close_stale_clients()
 
-def get_connection_string(inbound: Inbound, user_uuid: str, host_url: str, remark: str) -> str | None:
+add_host_listener(invalidate_session)
+add_host_listener(host_health.forget)
+
+def reality_params(inbound: Inbound) -> dict | None:
+    """Достаёт из инбаунда параметры reality, нужные для vless-ссылки, в виде колонок xui_hosts."""
     if not inbound: return None
-    settings = inbound.stream_settings.reality_settings.get("settings")
+    settings = inbound.reality_settings.get("settings")
     if not settings: return None
     
     public_key = settings.get("publicKey")
-    fp = settings.get("fingerprint")
-    server_names = inbound.stream_settings.reality_settings.get("serverNames")
-    short_ids = inbound.stream_settings.reality_settings.get("shortIds")
-    port = inbound.port
+    server_names = inbound.reality_settings.get("serverNames")
+    short_ids = inbound.reality_settings.get("shortIds")
     
     if not all([public_key, server_names, short_ids]): return None
     
-    parsed_url = urlparse(host_url)
-    short_id = short_ids[0]
+    return {
+        "inbound_port": inbound.port,
+        "reality_public_key": public_key,
+        "reality_fingerprint": settings.get("fingerprint"),
+        "reality_server_name": server_names[0],
+        "reality_short_id": short_ids[0]
+    }
+
+def host_link_params(host_data: dict, inbound: Inbound) -> dict | None:
+    """Параметры reality и части vless-ссылки хоста для сохранения в xui_hosts."""
+    params = reality_params(inbound)
+    if not params: return None
+    
+    parsed_url = urlparse(host_data['host_url'])
     
-    connection_string = (
-        f"vless://{user_uuid}@{parsed_url.hostname}:{port}"
-        f"?type=tcp&security=reality&pbk={public_key}&fp={fp}&sni={server_names[0]}"
-        f"&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{remark}"
+    params["link_prefix"] = "vless://"
+    params["link_suffix"] = (
+        f"@{parsed_url.hostname}:{params['inbound_port']}"
+        f"?type=tcp&security=reality&pbk={params['reality_public_key']}&fp={params['reality_fingerprint']}"
+        f"&sni={params['reality_server_name']}&sid={params['reality_short_id']}&spx=%2F&flow=xtls-rprx-vision#{host_data['host_name']}"
     )
-    return connection_string
+    return params
 
-def update_or_create_client_on_panel(api: Api, inbound_id: int, email: str, days_to_add: int) -> tuple[str | None, int | None]:
-    try:
-        inbound_to_modify = api.inbound.get_by_id(inbound_id)
-        if not inbound_to_modify:
+def get_connection_string(host_data: dict, user_uuid: str) -> str | None:
+    """Строит vless-ссылку из закэшированных в xui_hosts частей, без обращения к панели."""
+    if not host_data.get('link_suffix'): return None
+    return f"{host_data['link_prefix']}{user_uuid}{host_data['link_suffix']}"
+
+async def _ensure_link_params(host_data: dict) -> dict:
+    # Части ссылки ещё не закэшированы (новый хост или до первой синхронизации): один раз читаем инбаунд.
+    if host_data.get('link_suffix'):
+        return host_data
+    _, inbound = await get_session(host_data)
+    params = host_link_params(host_data, inbound)
+    if not params:
+        return host_data
+    # Смена частей ссылки запускает триггер, переписывающий ссылки всех ключей хоста: не в цикле событий.
+    await aio.update_host_reality_params(host_data['host_name'], params)
+    return {**host_data, **params}
+
+def _build_client(email: str, days_to_add: int, existing: Client | None) -> Client:
+    # Прежние версии бота продлевали ключ через reset (автопродление панелью на reset дней после окончания).
+    # Такие дни переносятся в expiryTime, а reset обнуляется; синхронизация считает срок так же: expiryTime + reset.
+    current_expiry_dt = None
+    if existing:
+        current_expiry_dt = datetime.fromtimestamp(existing.expiry_time / 1000) + timedelta(days=existing.reset)
+    if current_expiry_dt and current_expiry_dt > datetime.now():
+        new_expiry_dt = current_expiry_dt + timedelta(days=days_to_add)
+    else:
+        new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
+
+    # updateClient заменяет запись клиента целиком, поэтому при продлении переносим всё, что на панели
+    # задано для него (limitIp, subId, tgId, comment...), меняя только срок и включённость.
+    return Client(
+        id=existing.id if existing else str(uuid.uuid4()),
+        email=email,
+        enable=True,
+        flow=existing.flow if existing and existing.flow else "xtls-rprx-vision",
+        expiry_time=int(new_expiry_dt.timestamp() * 1000),
+        reset=0,
+        extra=dict(existing.extra) if existing else None
+    )
+
+def _resolve(future: asyncio.Future, result):
+    # Вызывающий мог уже перестать ждать (таймаут, отмена): его future не должна мешать остальной пачке.
+    if future.done():
+        return
+    if isinstance(result, BaseException):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
+class HostWriteQueue:
+    """Очередь изменений клиентов одного хоста.
+
+    Изменения выполняются по порядку одним воркером; подряд идущие создания и продления
+    из одной пачки объединяются: новые клиенты уходят одним addClient, повторные продления
+    одного email складываются в одно updateClient. Вызывающий получает future с результатом.
+    """
+
+    def __init__(self, host_name: str):
+        self.host_name = host_name
+        self._pending = deque()
+        self._worker: asyncio.Task | None = None
+
+    def submit(self, kind: str, payload: tuple) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, payload, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return future
+
+    async def _run(self):
+        # Даём одновременно пришедшим запросам попасть в первую пачку.
+        await asyncio.sleep(0)
+        while self._pending:
+            batch = [self._pending.popleft() for _ in range(min(WRITE_BATCH_MAX, len(self._pending)))]
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logger.error(f"Write queue for host '{self.host_name}' failed: {e}", exc_info=True)
+                for _, _, future in batch:
+                    _resolve(future, e)
+
+    async def _process(self, batch: list):
+        host_data = await aio.get_host(self.host_name)
+        if not host_data:
+            raise ValueError(f"Host '{self.host_name}' not found in the database")
+        xui, inbound = await get_session(host_data)
+        if not xui or not inbound:
+            raise ConnectionError(f"Could not log in or find inbound on host '{self.host_name}'")
+
+        for kind, run in groupby(batch, key=lambda item: item[0]):
+            run = list(run)
+            if kind == "upsert":
+                await self._apply_upserts(xui, inbound, run)
+            else:
+                await self._apply_deletes(xui, inbound.id, run)
+
+    async def _read_inbound(self, xui: XUIClient, inbound_id: int) -> Inbound:
+        inbound = await xui.get_inbound(inbound_id)
+        if not inbound:
             raise ValueError(f"Could not find inbound with ID {inbound_id}")
+        update_session_inbound(self.host_name, inbound)
+        return inbound
 
-        if inbound_to_modify.settings.clients is None:
-            inbound_to_modify.settings.clients = []
-            
-        client_index = -1
-        for i, client in enumerate(inbound_to_modify.settings.clients):
-            if client.email == email:
-                client_index = i
-                break
-        
-        if client_index != -1:
-            existing_client = inbound_to_modify.settings.clients[client_index]
-            if existing_client.expiry_time > int(datetime.now().timestamp() * 1000):
-                current_expiry_dt = datetime.fromtimestamp(existing_client.expiry_time / 1000)
-                new_expiry_dt = current_expiry_dt + timedelta(days=days_to_add)
+    async def _lookup_clients(self, xui: XUIClient, inbound: Inbound, emails: list[str]) -> tuple[Inbound, list]:
+        """Для каждого email возвращает клиента с панели (None, если его нет) либо исключение.
+
+        Полная запись клиента, нужная для продления, берётся из инбаунда сессии: его обновляют сама
+        очередь после своих записей и синхронизация при каждом чтении. Весь инбаунд читается заново
+        только для большой пачки или если клиента в кэше нет. Возвращает и инбаунд, по которому искали.
+        """
+        if len(emails) >= WRITE_LOOKUP_INBOUND_MIN:
+            inbound = await self._read_inbound(xui, inbound.id)
+            return inbound, [inbound.get_client(email) for email in emails]
+
+        # Наличие клиента проверяем по статистике: это один короткий запрос на email.
+        traffic = await asyncio.gather(*(xui.get_client_traffic(email) for email in emails), return_exceptions=True)
+        if any(found and not isinstance(found, Exception) and not inbound.get_client(email) for email, found in zip(emails, traffic)):
+            # Клиента добавили на панели после последнего чтения инбаунда.
+            inbound = await self._read_inbound(xui, inbound.id)
+        lookups = []
+        for email, found in zip(emails, traffic):
+            client = inbound.get_client(email)
+            if isinstance(found, Exception) or not found:
+                lookups.append(found or None)
+            elif client:
+                # Срок берём из статистики: она прочитана только что, а запись в кэше могла отстать от панели.
+                lookups.append(Client.from_dict({**client.to_dict(), "expiryTime": found.get("expiryTime", client.expiry_time)}))
             else:
-                new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
-        else:
-            new_expiry_dt = datetime.now() + timedelta(days=days_to_add)
+                lookups.append(ValueError(f"Client '{email}' has traffic stats on the panel but is missing from inbound {inbound.id}"))
+        return inbound, lookups
 
-        new_expiry_ms = int(new_expiry_dt.timestamp() * 1000)
+    async def _apply_upserts(self, xui: XUIClient, inbound: Inbound, run: list):
+        days_by_email = {}
+        for _, (email, days_to_add), _ in run:
+            days_by_email[email] = days_by_email.get(email, 0) + days_to_add
+        emails = list(days_by_email)
+        inbound, lookups = await self._lookup_clients(xui, inbound, emails)
+        inbound_id = inbound.id
 
-        if client_index != -1:
-            inbound_to_modify.settings.clients[client_index].reset = days_to_add
-            inbound_to_modify.settings.clients[client_index].enable = True
-            
-            client_uuid = inbound_to_modify.settings.clients[client_index].id
-        else:
-            client_uuid = str(uuid.uuid4())
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=True,
-                flow="xtls-rprx-vision",
-                expiry_time=new_expiry_ms
-            )
-            inbound_to_modify.settings.clients.append(new_client)
+        results = {}
+        built = {}
+        new_clients = []
+        for email, lookup in zip(emails, lookups):
+            if isinstance(lookup, Exception):
+                results[email] = lookup
+                continue
+            try:
+                client = built[email] = _build_client(email, days_by_email[email], lookup)
+                if lookup:
+                    await xui.update_client(inbound_id, client)
+                    results[email] = (client.id, client.expiry_time)
+                else:
+                    new_clients.append(client)
+            except Exception as e:
+                results[email] = e
 
-        api.inbound.update(inbound_id, inbound_to_modify)
+        if new_clients:
+            try:
+                await xui.add_clients(inbound_id, new_clients)
+                results.update((client.email, (client.id, client.expiry_time)) for client in new_clients)
+            except Exception as e:
+                if len(new_clients) == 1:
+                    results[new_clients[0].email] = e
+                else:
+                    # Одна ошибка отклоняет всю пачку; добавляем по одному, чтобы не потерять остальных.
+                    logger.warning(f"Batched addClient of {len(new_clients)} clients on host '{self.host_name}' failed ({e}), retrying one by one.")
+                    for client in new_clients:
+                        try:
+                            await xui.add_client(inbound_id, client)
+                            results[client.email] = (client.id, client.expiry_time)
+                        except Exception as client_error:
+                            results[client.email] = client_error
+            if len(new_clients) > 1:
+                logger.info(f"Added {len(new_clients)} clients on host '{self.host_name}' in one panel write.")
 
-        return client_uuid, new_expiry_ms
+        # Записанные клиенты сразу попадают в кэш инбаунда, и их следующее продление не читает инбаунд.
+        inbound.put_clients([built[email] for email, result in results.items() if not isinstance(result, Exception)])
+        for _, (email, _), future in run:
+            _resolve(future, results[email])
 
-    except Exception as e:
-        logger.error(f"Error in update_or_create_client_on_panel: {e}", exc_info=True)
-        return None, None
+    async def _apply_deletes(self, xui: XUIClient, inbound_id: int, run: list):
+        for _, (client_uuid,), future in run:
+            try:
+                await xui.delete_client(inbound_id, client_uuid)
+                result = True
+            except Exception as e:
+                result = e
+            _resolve(future, result)
+
+_write_queues: dict[str, HostWriteQueue] = {}
+
+def _get_write_queue(host_name: str) -> HostWriteQueue:
+    queue = _write_queues.get(host_name)
+    if queue is None:
+        queue = _write_queues[host_name] = HostWriteQueue(host_name)
+    return queue
+
+def enqueue_client_upsert(host_name: str, email: str, days_to_add: int) -> asyncio.Future:
+    """Ставит создание или продление клиента в очередь хоста; future вернёт (client_uuid, expiry_ms)."""
+    return _get_write_queue(host_name).submit("upsert", (email, days_to_add))
+
+def enqueue_client_delete(host_name: str, client_uuid: str) -> asyncio.Future:
+    """Ставит удаление клиента в очередь хоста; future вернёт True."""
+    return _get_write_queue(host_name).submit("delete", (client_uuid,))
 
 async def create_or_update_key_on_host(host_name: str, email: str, days_to_add: int) -> Dict | None:
-    host_data = get_host(host_name)
+    host_data = await aio.get_host(host_name)
     if not host_data:
         logger.error(f"Workflow failed: Host '{host_name}' not found in the database.")
         return None
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-    if not api or not inbound:
-        logger.error(f"Workflow failed: Could not log in or find inbound on host '{host_name}'.")
-        return None
-        
-    client_uuid, new_expiry_ms = update_or_create_client_on_panel(api, inbound.id, email, days_to_add)
-    if not client_uuid:
-        logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}'.")
+    try:
+        client_uuid, new_expiry_ms = await enqueue_client_upsert(host_name, email, days_to_add)
+    except Exception as e:
+        logger.error(f"Workflow failed: Could not create/update client '{email}' on host '{host_name}': {e}")
         return None
-    
-    connection_string = get_connection_string(inbound, client_uuid, host_data['host_url'], remark=host_name)
+
+    host_data = await _ensure_link_params(host_data)
+    connection_string = get_connection_string(host_data, client_uuid)
     
     logger.info(f"Successfully processed key for '{email}' on host '{host_name}'.")
     
@@ -133,54 +407,40 @@ async def create_or_update_key_on_host(host_name: str, email: str, days_to_add:
     }
 
 async def get_key_details_from_host(key_data: dict) -> dict | None:
+    if key_data.get('connection_string'):
+        return {"connection_string": key_data['connection_string']}
+
     host_name = key_data.get('host_name')
     if not host_name:
         logger.error(f"Could not get key details: host_name is missing for key_id {key_data.get('key_id')}")
         return None
 
-    host_db_data = get_host(host_name)
+    host_db_data = await aio.get_host(host_name)
     if not host_db_data:
         logger.error(f"Could not get key details: Host '{host_name}' not found in the database.")
         return None
 
-    api, inbound = login_to_host(
-        host_url=host_db_data['host_url'],
-        username=host_db_data['host_username'],
-        password=host_db_data['host_pass'],
-        inbound_id=host_db_data['host_inbound_id']
-    )
-    if not api or not inbound: return None
-
-    connection_string = get_connection_string(inbound, key_data['xui_client_uuid'], host_db_data['host_url'], remark=host_name)
+    host_db_data = await _ensure_link_params(host_db_data)
+    connection_string = get_connection_string(host_db_data, key_data['xui_client_uuid'])
+    if not connection_string: return None
     return {"connection_string": connection_string}
 
 async def delete_client_on_host(host_name: str, client_email: str) -> bool:
-    host_data = get_host(host_name)
+    host_data = await aio.get_host(host_name)
     if not host_data:
         logger.error(f"Cannot delete client: Host '{host_name}' not found.")
         return False
 
-    api, inbound = login_to_host(
-        host_url=host_data['host_url'],
-        username=host_data['host_username'],
-        password=host_data['host_pass'],
-        inbound_id=host_data['host_inbound_id']
-    )
-
-    if not api or not inbound:
-        logger.error(f"Cannot delete client: Login or inbound lookup failed for host '{host_name}'.")
-        return False
-        
     try:
-        client_to_delete = get_key_by_email(client_email)
+        client_to_delete = await aio.get_key_by_email(client_email)
         if client_to_delete:
-            api.client.delete(inbound.id, client_to_delete['xui_client_uuid'])
+            await enqueue_client_delete(host_name, client_to_delete['xui_client_uuid'])
             logger.info(f"Successfully deleted client '{client_to_delete['xui_client_uuid']}' from host '{host_name}'.")
             return True
         else:
-            logger.warning(f"Client '{client_to_delete['xui_client_uuid']}' not found on host '{host_name}' for deletion (already gone).")
+            logger.warning(f"Client '{client_email}' not found on host '{host_name}' for deletion (already gone).")
             return True
             
     except Exception as e:
-        logger.error(f"Failed to delete client '{client_to_delete['xui_client_uuid']}' from host '{host_name}': {e}", exc_info=True)
-        return False
\ No newline at end of file
+        logger.error(f"Failed to delete client '{client_email}' from host '{host_name}': {e}", exc_info=True)
+        return False
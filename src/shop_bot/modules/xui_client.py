@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from shop_bot.modules import host_health
+
+logger = logging.getLogger(__name__)
+
+XUI_REQUEST_TIMEOUT_SECONDS = 15
+XUI_CONNECT_TIMEOUT_SECONDS = 5
+XUI_MAX_CONNECTIONS_PER_HOST = 4
+
+class XUIError(Exception):
+    """Панель 3x-ui ответила ошибкой."""
+
+class XUIAuthError(XUIError):
+    """Не удалось войти в панель 3x-ui."""
+
+def _json_field(value) -> dict:
+    # Панель отдаёт settings/streamSettings как JSON-строки.
+    if isinstance(value, str):
+        return json.loads(value) if value else {}
+    return value or {}
+
+class Client:
+    """Клиент инбаунда. Поля, которые бот не использует, сохраняются в extra и отправляются обратно как есть."""
+
+    def __init__(self, id: str, email: str, enable: bool = True, flow: str = "",
+                 expiry_time: int = 0, reset: int = 0, extra: dict | None = None):
+        self.id = id
+        self.email = email
+        self.enable = enable
+        self.flow = flow
+        self.expiry_time = expiry_time
+        self.reset = reset
+        self.extra = extra or {}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Client":
+        data = dict(data)
+        return cls(
+            id=data.pop("id", ""),
+            email=data.pop("email", ""),
+            enable=data.pop("enable", True),
+            flow=data.pop("flow", ""),
+            expiry_time=data.pop("expiryTime", 0) or 0,
+            reset=data.pop("reset", 0) or 0,
+            extra=data
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "limitIp": 0,
+            "totalGB": 0,
+            **self.extra,
+            "id": self.id,
+            "email": self.email,
+            "enable": self.enable,
+            "flow": self.flow,
+            "expiryTime": self.expiry_time,
+            "reset": self.reset
+        }
+
+class Inbound:
+    """Инбаунд панели: id, порт, клиенты и stream settings."""
+
+    def __init__(self, raw: dict):
+        self.id = raw.get("id")
+        self.port = raw.get("port")
+        self.settings = _json_field(raw.get("settings"))
+        self.stream_settings = _json_field(raw.get("streamSettings"))
+        self.clients = [Client.from_dict(client) for client in self.settings.get("clients") or []]
+        self._positions: dict[str, int] | None = None
+
+    def _client_positions(self) -> dict[str, int]:
+        if self._positions is None:
+            self._positions = {client.email: position for position, client in enumerate(self.clients)}
+        return self._positions
+
+    def get_client(self, email: str) -> Client | None:
+        position = self._client_positions().get(email)
+        return self.clients[position] if position is not None else None
+
+    def put_clients(self, new_clients: list[Client]):
+        """Добавляет клиентов или заменяет клиентов с теми же email.
+
+        Список заменяется копией, поэтому тот, кто уже перебирает прежний список, его изменений не видит.
+        """
+        positions = self._client_positions()
+        clients = list(self.clients)
+        for client in new_clients:
+            position = positions.get(client.email)
+            if position is None:
+                positions[client.email] = len(clients)
+                clients.append(client)
+            else:
+                clients[position] = client
+        self.clients = clients
+
+    @property
+    def reality_settings(self) -> dict:
+        return self.stream_settings.get("realitySettings") or {}
+
+class XUIClient:
+    """Асинхронный клиент API 3x-ui для одного хоста.
+
+    Держит одну aiohttp-сессию с keep-alive соединениями и cookie панели. При истёкшей
+    сессии (401/404 или редирект на страницу входа) выполняет повторный вход и повторяет запрос.
+    """
+
+    def __init__(self, host_url: str, username: str, password: str, host_name: str | None = None):
+        self.base_url = host_url.rstrip("/")
+        # Если задано имя хоста, каждый запрос проходит через его автомат в host_health.
+        self.host_name = host_name
+        self.username = username
+        self.password = password
+        self._session: aiohttp.ClientSession | None = None
+        self._login_lock = asyncio.Lock()
+        self._logged_in = False
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=XUI_REQUEST_TIMEOUT_SECONDS, connect=XUI_CONNECT_TIMEOUT_SECONDS),
+                connector=aiohttp.TCPConnector(limit_per_host=XUI_MAX_CONNECTIONS_PER_HOST),
+                # Панели часто открыты по IP, а стандартный cookie jar такие cookie не принимает.
+                cookie_jar=aiohttp.CookieJar(unsafe=True)
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._logged_in = False
+
+    async def _call(self, method: str, url: str, **kwargs) -> tuple[int, dict | None]:
+        """Выполняет HTTP-запрос и учитывает его результат в состоянии хоста; возвращает статус и JSON-ответ."""
+        if self.host_name:
+            host_health.check(self.host_name)
+        started = time.perf_counter()
+        try:
+            async with self._get_session().request(method, url, **kwargs) as response:
+                status = response.status
+                payload = await response.json() if response.content_type == "application/json" else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if self.host_name:
+                host_health.record_failure(self.host_name, e)
+            raise
+        if self.host_name:
+            if status >= 500:
+                host_health.record_failure(self.host_name, XUIError(f"HTTP {status}"))
+            else:
+                host_health.record_success(self.host_name, (time.perf_counter() - started) * 1000)
+        return status, payload
+
+    async def login(self):
+        status, payload = await self._call("POST", f"{self.base_url}/login", data={"username": self.username, "password": self.password})
+        if status != 200 or payload is None:
+            raise XUIAuthError(f"Login to '{self.base_url}' failed with HTTP {status}")
+        if not payload.get("success"):
+            raise XUIAuthError(f"Login to '{self.base_url}' rejected: {payload.get('msg')}")
+        self._logged_in = True
+
+    async def _ensure_login(self):
+        async with self._login_lock:
+            if not self._logged_in:
+                await self.login()
+
+    async def _request(self, method: str, path: str, **kwargs):
+        url = f"{self.base_url}/panel/api/inbounds/{path}"
+        for attempt in range(2):
+            await self._ensure_login()
+            status, payload = await self._call(method, url, **kwargs)
+            if status in (401, 404) or payload is None:
+                if attempt == 0:
+                    logger.info(f"Session for '{self.base_url}' expired (HTTP {status}), logging in again.")
+                    self._logged_in = False
+                    continue
+                raise XUIAuthError(f"{method} {url} is not authorized (HTTP {status})")
+            if status >= 400:
+                raise XUIError(f"{method} {url} failed with HTTP {status}")
+            if not payload.get("success"):
+                raise XUIError(f"{method} {url} failed: {payload.get('msg')}")
+            return payload.get("obj")
+
+    async def get_inbounds(self) -> list[Inbound]:
+        return [Inbound(raw) for raw in await self._request("GET", "list") or []]
+
+    async def get_inbound(self, inbound_id: int) -> Inbound | None:
+        raw = await self._request("GET", f"get/{inbound_id}")
+        return Inbound(raw) if raw else None
+
+    async def add_client(self, inbound_id: int, client: Client):
+        await self.add_clients(inbound_id, [client])
+
+    async def add_clients(self, inbound_id: int, clients: list[Client]):
+        # addClient принимает список: несколько клиентов добавляются одной записью инбаунда.
+        await self._request("POST", "addClient", json={"id": inbound_id, "settings": json.dumps({"clients": [client.to_dict() for client in clients]})})
+
+    async def update_client(self, inbound_id: int, client: Client):
+        await self._request("POST", f"updateClient/{client.id}", json={"id": inbound_id, "settings": json.dumps({"clients": [client.to_dict()]})})
+
+    async def delete_client(self, inbound_id: int, client_uuid: str):
+        await self._request("POST", f"{inbound_id}/delClient/{client_uuid}")
+
+    async def get_client_traffic(self, email: str) -> dict | None:
+        return await self._request("GET", f"getClientTraffics/{email}")
@@ -7,20 +7,19 @@ import base64
 from hmac import compare_digest
 from datetime import datetime
 from functools import wraps
-from math import ceil
 from flask import Flask, request, render_template, redirect, url_for, flash, session, current_app, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-from shop_bot.modules import xui_api
+from shop_bot.modules import xui_api, host_health
 from shop_bot.bot import handlers 
 from shop_bot.data_manager.database import (
     get_all_settings, update_setting, get_all_hosts, get_plans_for_host,
     create_host, delete_host, create_plan, delete_plan, get_user_count,
-    get_total_keys_count, get_total_spent_sum, get_daily_stats_for_charts,
-    get_recent_transactions, get_paginated_transactions, get_all_users, get_user_keys,
+    get_total_keys_count, get_total_spent_sum, get_host_count, get_daily_stats_for_charts,
+    get_recent_transactions, get_transactions_page, get_transactions_count, get_all_users, get_user_keys,
     ban_user, unban_user, delete_user_keys, get_setting, find_and_complete_ton_transaction,
     get_pending_bank_payment_documents, get_bank_payment_document, update_bank_payment_document_status,
     get_transaction_by_id, update_transaction_status, get_referral_balance, get_user_referrals,
@@ -128,14 +127,15 @@ def create_webhook_app(bot_controller_instance):
             "user_count": get_user_count(),
             "total_keys": get_total_keys_count(),
             "total_spent": get_total_spent_sum(),
-            "host_count": len(get_all_hosts())
+            "host_count": get_host_count()
         }
         
-        page = request.args.get('page', 1, type=int)
+        after = request.args.get('after', type=int)
+        before = request.args.get('before', type=int)
         per_page = 8
         
-        transactions, total_transactions = get_paginated_transactions(page=page, per_page=per_page)
-        total_pages = ceil(total_transactions / per_page)
+        transactions, next_cursor, prev_cursor = get_transactions_page(per_page=per_page, after=after, before=before)
+        total_transactions = get_transactions_count()
         
         chart_data = get_daily_stats_for_charts(days=30)
         common_data = get_common_template_data()
@@ -145,8 +145,9 @@ def create_webhook_app(bot_controller_instance):
             stats=stats,
             chart_data=chart_data,
             transactions=transactions,
-            current_page=page,
-            total_pages=total_pages,
+            next_cursor=next_cursor,
+            prev_cursor=prev_cursor,
+            total_transactions=total_transactions,
             **common_data
         )
 
@@ -166,19 +167,6 @@ def create_webhook_app(bot_controller_instance):
     def payments_page():
         try:
             documents = get_pending_bank_payment_documents()
-            for doc in documents:
-                if doc.get('metadata'):
-                    try:
-                        metadata = json.loads(doc['metadata'])
-                        doc['plan_name'] = metadata.get('plan_name', 'N/A')
-                        doc['host_name'] = metadata.get('host_name', 'N/A')
-                    except Exception as e:
-                        logger.error(f"Error parsing metadata for document {doc.get('document_id')}: {e}")
-                        doc['plan_name'] = 'N/A'
-                        doc['host_name'] = 'N/A'
-                else:
-                    doc['plan_name'] = 'N/A'
-                    doc['host_name'] = 'N/A'
         except Exception as e:
             logger.error(f"Error getting pending documents: {e}", exc_info=True)
             documents = []
@@ -293,6 +281,10 @@ def create_webhook_app(bot_controller_instance):
         for host in hosts:
             host['plans'] = get_plans_for_host(host['host_name'])
         
+        health = host_health.snapshot()
+        for host in hosts:
+            host['health'] = health.get(host['host_name'])
+        
         common_data = get_common_template_data()
         return render_template('settings.html', settings=current_settings, hosts=hosts, **common_data)
 
@@ -343,9 +335,19 @@ def create_webhook_app(bot_controller_instance):
     def revoke_keys_route(user_id):
         keys_to_revoke = get_user_keys(user_id)
         success_count = 0
+        # Клиенты панелей привязаны к основному циклу событий, поэтому удаление выполняется в нём.
+        loop = current_app.config.get('EVENT_LOOP')
         
         for key in keys_to_revoke:
-            result = asyncio.run(xui_api.delete_client_on_host(key['host_name'], key['key_email']))
+            if not loop or not loop.is_running():
+                logger.error("Event loop is not available, cannot revoke keys on hosts.")
+                break
+            future = asyncio.run_coroutine_threadsafe(xui_api.delete_client_on_host(key['host_name'], key['key_email']), loop)
+            try:
+                result = future.result(timeout=30)
+            except Exception as e:
+                logger.error(f"Failed to revoke key '{key['key_email']}' on host '{key['host_name']}': {e}")
+                result = False
             if result:
                 success_count += 1
         
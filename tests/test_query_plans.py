@@ -0,0 +1,55 @@
+import re
+
+import pytest
+
+from shop_bot.data_manager import database
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(database, "DB_FILE", tmp_path_factory.mktemp("db") / "users.db")
+        database._pool.close_all()
+        database.initialize_db()
+        yield database
+        database._pool.close_all()
+
+
+def executed_selects(db, call) -> list[str]:
+    """SQL запросов SELECT, которые выполняет call, с подставленными параметрами."""
+    statements = []
+    with db.get_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+    return [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+
+
+def query_plan(db, sql: str) -> list[str]:
+    with db.get_connection() as conn:
+        return [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+HOT_LOOKUPS = {
+    "get_user_keys": lambda db: db.get_user_keys(1),
+    "get_keys_for_host": lambda db: db.get_keys_for_host("host-1"),
+    "get_referral_count": lambda db: db.get_referral_count(1),
+    "get_user_referrals": lambda db: db.get_user_referrals(1),
+    "get_latest_transaction": lambda db: db.get_latest_transaction(1),
+    "get_user_id_by_thread": lambda db: db.get_user_id_by_thread(1),
+    "get_daily_stats_for_charts": lambda db: db.get_daily_stats_for_charts(30),
+}
+
+
+@pytest.mark.parametrize("name", HOT_LOOKUPS)
+def test_hot_lookup_searches_an_index(db, name):
+    selects = executed_selects(db, lambda: HOT_LOOKUPS[name](db))
+    assert selects, f"{name} executed no SELECT"
+    for sql in selects:
+        plan = query_plan(db, sql)
+        table_steps = [step for step in plan if re.match(r"(SEARCH|SCAN) ", step)]
+        assert table_steps, plan
+        for step in table_steps:
+            assert re.match(r"SEARCH \w+ USING (COVERING )?INDEX ", step), f"{name}: {sql!r} -> {plan}"
@@ -0,0 +1,72 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from shop_bot.data_manager import database
+
+HOST_KEYS = 20000
+SYNC_WRITES = 3
+READERS = 4
+
+# Как было до профиля хранения: журнал отката и только таймаут sqlite3.connect по умолчанию.
+ROLLBACK_JOURNAL = ("DELETE", {"busy_timeout": 5000})
+WAL_PROFILE = (database.DB_JOURNAL_MODE, dict(database.STORAGE_PROFILE))
+
+
+def stress(tmp_path, monkeypatch, journal_mode: str, profile: dict) -> tuple[float, list[str]]:
+    """Синхронизация хоста с HOST_KEYS ключами переписывает их сроки, пока READERS потоков
+    открывают «Мои ключи». Возвращает худшую задержку чтения в мс и ошибки sqlite."""
+    monkeypatch.setattr(database, "DB_FILE", tmp_path / f"{journal_mode.lower()}.db")
+    monkeypatch.setattr(database, "DB_JOURNAL_MODE", journal_mode)
+    monkeypatch.setattr(database, "STORAGE_PROFILE", profile)
+    database._pool.close_all()
+    database.initialize_db()
+    with database.get_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0].upper() == journal_mode
+        conn.executemany(
+            "INSERT INTO vpn_keys (user_id, host_name, xui_client_uuid, key_email, expiry_date, expiry_ms) VALUES (?, ?, ?, ?, ?, ?)",
+            [(i % 2000, "host-1", f"uuid-{i}", f"key-{i}", "2030-01-01", 1_900_000_000_000) for i in range(HOST_KEYS)]
+        )
+
+    done = threading.Event()
+    latencies = []
+    errors = []
+
+    def writer():
+        try:
+            for n in range(1, SYNC_WRITES + 1):
+                updates = [(f"key-{i}", f"uuid-{i}", 1_900_000_000_000 + n * 1000) for i in range(HOST_KEYS)]
+                if database.apply_sync_changes("host-1", updates, []) is None:
+                    errors.append("apply_sync_changes failed")
+        finally:
+            done.set()
+
+    def reader(user_id: int):
+        while not done.is_set():
+            started = time.perf_counter()
+            try:
+                database.get_user_keys(user_id)
+            except sqlite3.Error as e:
+                errors.append(str(e))
+            latencies.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader, args=(i,)) for i in range(READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    database._pool.close_all()
+    return max(latencies), errors
+
+
+def test_readers_do_not_stall_behind_sync_writes(tmp_path, monkeypatch):
+    rollback_worst_ms, rollback_errors = stress(tmp_path, monkeypatch, *ROLLBACK_JOURNAL)
+    wal_worst_ms, wal_errors = stress(tmp_path, monkeypatch, *WAL_PROFILE)
+
+    assert not rollback_errors and not wal_errors
+    # В журнале отката читатели ждут, пока запись синхронизации фиксируется в файле базы;
+    # в WAL они читают последнюю зафиксированную версию и писателя не ждут.
+    assert wal_worst_ms * 5 < rollback_worst_ms, (wal_worst_ms, rollback_worst_ms)